@@ -0,0 +1,63 @@
+#
+# Aggregation of identical Passive DNS records before their ingestion.
+#
+# This software is part of the D4 project.
+#
+# The software is released under the GNU Affero General Public version 3.
+#
+# Copyright (c) Computer Incident Response Center Luxembourg (CIRCL)
+
+import time
+
+
+class Aggregator:
+    """Coalesce identical (rrname, rdata, type) records.
+
+    The lowest and highest timestamps and the number of occurrences are
+    kept for each distinct record. The aggregator is due for a flush
+    once it holds max_entries distinct records or when the oldest one
+    has been waiting for window seconds.
+    """
+
+    def __init__(self, max_entries=500, window=1):
+        self.max_entries = max_entries
+        self.window = window
+        self.entries = {}
+        # number of records added, including the coalesced ones
+        self.records = 0
+        self.start = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, rrname, rdata, rrtype, timestamp, count=1):
+        if not self.entries:
+            self.start = time.monotonic()
+        self.records += count
+        key = (rrname, rdata, rrtype)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.entries[key] = [timestamp, timestamp, count]
+            return
+        if timestamp < entry[0]:
+            entry[0] = timestamp
+        elif timestamp > entry[1]:
+            entry[1] = timestamp
+        entry[2] += count
+
+    def due(self):
+        if not self.entries:
+            return False
+        return len(self.entries) >= self.max_entries or time.monotonic() - self.start >= self.window
+
+    def drain(self):
+        """Return the (rrname, rdata, type, first, last, count) aggregated
+        records and the number of records they stand for, and empty the
+        aggregator.
+        """
+        aggregated = [key + tuple(entry) for key, entry in self.entries.items()]
+        records = self.records
+        self.entries = {}
+        self.records = 0
+        self.start = None
+        return aggregated, records
@@ -0,0 +1,86 @@
+#
+# In-process LRU cache of query results for the COF server.
+#
+# This software is part of the D4 project.
+#
+# The software is released under the GNU Affero General Public version 3.
+#
+# Copyright (c) Computer Incident Response Center Luxembourg (CIRCL)
+
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """LRU cache of serialized results bounded in bytes.
+
+    Entries expire after ttl seconds, empty results are kept for
+    negative_ttl seconds (0 to disable negative caching).
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=300, negative_ttl=60):
+        self.max_bytes = max_bytes
+        # a single entry can't take more than a fraction of the cache
+        self.max_entry = max_bytes // 16
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0 and self.ttl > 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expire, body, headers = entry
+        if expire < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return body, headers
+
+    def set(self, key, body, headers=None):
+        ttl = self.ttl if body else self.negative_ttl
+        size = len(key) + len(body)
+        if not self.enabled or ttl <= 0 or size > self.max_entry:
+            return False
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + ttl, body, headers or {})
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+        return True
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'size': self.size,
+            'max_size': self.max_bytes,
+            'ttl': self.ttl,
+            'negative_ttl': self.negative_ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    def _remove(self, key):
+        _, body, _ = self.entries.pop(key)
+        self.size -= len(key) + len(body)
@@ -0,0 +1,172 @@
+#
+# Readers of Passive DNS Common Output Format (COF) exports.
+#
+# https://tools.ietf.org/html/draft-dulaunoy-dnsop-passive-dns-cof
+#
+# This software is part of the D4 project.
+#
+# The software is released under the GNU Affero General Public version 3.
+#
+# Copyright (c) Computer Incident Response Center Luxembourg (CIRCL)
+
+import codecs
+import gzip
+import json
+import mmap
+import os
+import re
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_json_array(fileobj=None, offset=0, chunk_size=1024 * 1024):
+    """Iterate over the elements of a JSON array without loading it.
+
+    fileobj is a file opened in binary mode. (element, offset) tuples are
+    yielded, offset being the position in bytes right after the element
+    which can be given back to resume the iteration.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    fileobj.seek(offset)
+    text = ''
+    pos = 0
+    # byte offset of text[pos]
+    bpos = offset
+    eof = False
+    # the opening bracket is expected at the start, after an element a
+    # comma or the closing bracket is expected
+    state = 'start' if offset == 0 else 'after'
+
+    while True:
+        end = WHITESPACE.match(text, pos).end()
+        # whitespaces are single bytes
+        bpos += end - pos
+        pos = end
+        if pos == len(text):
+            if eof:
+                raise ValueError(f'unexpected end of JSON array at offset {bpos}')
+            chunk = fileobj.read(chunk_size)
+            eof = not chunk
+            text = utf8.decode(chunk, final=eof)
+            pos = 0
+            continue
+        if state == 'start':
+            if text[pos] != '[':
+                raise ValueError(f'JSON array expected at offset {bpos}')
+            state = 'first'
+            pos += 1
+            bpos += 1
+        elif state == 'after':
+            if text[pos] == ']':
+                return
+            if text[pos] != ',':
+                raise ValueError(f'comma expected at offset {bpos}')
+            state = 'value'
+            pos += 1
+            bpos += 1
+        else:
+            if state == 'first' and text[pos] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(text, pos)
+            except json.JSONDecodeError:
+                element, end = None, None
+            # an element ending with the buffer can be truncated
+            if end is None or (end == len(text) and not eof):
+                if eof:
+                    raise ValueError(f'invalid JSON element at offset {bpos}')
+                chunk = fileobj.read(chunk_size)
+                eof = not chunk
+                text = text[pos:] + utf8.decode(chunk, final=eof)
+                pos = 0
+                continue
+            bpos += len(text[pos:end].encode())
+            pos = end
+            state = 'after'
+            yield element, bpos
+
+
+def valid_record(rdns=None):
+    """Check the fields of a COF record written by the importers.
+
+    rrname, rrtype and rdata must be strings, time_first and time_last
+    numbers and count (optional) a positive integer, the timestamps and
+    the count are converted in place. An invalid record would fail the whole batch.
+    """
+    if not isinstance(rdns, dict):
+        return False
+    for field in ('rrname', 'rrtype', 'rdata'):
+        if not isinstance(rdns.get(field), str):
+            return False
+    if not rdns['rrname']:
+        return False
+    try:
+        rdns['time_first'] = float(rdns['time_first'])
+        rdns['time_last'] = float(rdns['time_last'])
+        if 'count' in rdns:
+            rdns['count'] = int(rdns['count'])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return rdns.get('count', 1) >= 1
+
+
+def open_dump(path=None):
+    """Open a NDJSON dump in binary mode, .gz and .zst dumps are
+    decompressed on the fly (zstandard is needed for the latter)."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(f'the zstandard module is required to read {path}')
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return open(path, 'rb')
+
+
+def split_ranges(path=None, size=64 * 1024 * 1024):
+    """Split an uncompressed NDJSON dump in (start, end) byte ranges of
+    about size bytes, each range ending on a newline."""
+    ranges = []
+    with open(path, 'rb') as f:
+        total = os.fstat(f.fileno()).st_size
+        if total == 0:
+            return ranges
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            start = 0
+            while start < total:
+                end = m.find(b'\n', min(start + size, total) - 1)
+                end = total if end == -1 else end + 1
+                ranges.append((start, end))
+                start = end
+    return ranges
+
+
+def read_range(path=None, start=0, end=0):
+    """Return the lines of a byte range of an uncompressed NDJSON dump."""
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return m[start:end].splitlines()
+
+
+def iter_blocks(fileobj=None, size=4 * 1024 * 1024):
+    """Iterate over blocks of complete lines of about size bytes read from a
+    (possibly decompressing) file object."""
+    rest = b''
+    while True:
+        chunk = fileobj.read(size)
+        if not chunk:
+            break
+        chunk = rest + chunk
+        cut = chunk.rfind(b'\n')
+        if cut == -1:
+            rest = chunk
+            continue
+        rest = chunk[cut + 1:]
+        yield chunk[:cut + 1]
+    if rest:
+        yield rest
@@ -0,0 +1,45 @@
+#
+# Bulk consumer of a D4 analyzer queue.
+#
+# This software is part of the D4 project.
+#
+# The software is released under the GNU Affero General Public version 3.
+#
+# Copyright (c) Computer Incident Response Center Luxembourg (CIRCL)
+
+
+class D4Queue:
+    """Pop lines from a D4 analyzer queue (analyzer:<type>:<uuid>) in bulk.
+
+    The D4 server pushes on the left of the list, the lines are taken from
+    the right with LRANGE+LTRIM in a MULTI (RPOP with a count is not
+    available before Redis 6.2). The number of lines taken per call follows
+    the depth of the queue observed at the previous call. When the queue
+    is empty, BRPOP is used to wait for the next line.
+    """
+
+    def __init__(self, r, queue, min_batch=16, max_batch=1000, timeout=1):
+        self.r = r
+        self.queue = queue
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.depth = 0
+
+    def pop(self, block=True):
+        size = max(self.min_batch, min(self.max_batch, self.depth))
+        pipe = self.r.pipeline(transaction=True)
+        pipe.lrange(self.queue, -size, -1)
+        pipe.ltrim(self.queue, 0, -size - 1)
+        pipe.llen(self.queue)
+        lines, _, self.depth = pipe.execute()
+        if lines:
+            # oldest line is the rightmost one
+            lines.reverse()
+            return lines
+        if not block:
+            return []
+        line = self.r.brpop(self.queue, timeout=self.timeout)
+        if line is None:
+            return []
+        return [line[1]]
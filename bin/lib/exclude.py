@@ -0,0 +1,123 @@
+#
+# Exclusion of Passive DNS records by rrname.
+#
+# This software is part of the D4 project.
+#
+# The software is released under the GNU Affero General Public version 3.
+#
+# Copyright (c) Computer Incident Response Center Luxembourg (CIRCL)
+
+from collections import Counter, deque
+
+
+class Exclusion:
+    """Match rrnames against a set of exclusion rules.
+
+    Substring rules are compiled into an Aho-Corasick automaton and zone
+    rules into a trie of reversed labels, a rrname is then matched in a
+    single pass whatever the number of rules.
+
+    The rules are the substrings given at creation (the substring option
+    of analyzer.conf) and the ones of an optional file with one rule per
+    line:
+
+        # comment
+        substring:spamhaus.org
+        suffix:in-addr.arpa
+
+    A line without prefix is a substring rule. A suffix rule matches the
+    zone and all its subdomains.
+    """
+
+    def __init__(self, substrings=None, path=None):
+        self.substrings = [x.strip().lower() for x in substrings or [] if x.strip()]
+        self.path = path
+        self.hits = Counter()
+        self.reload()
+
+    def reload(self):
+        substrings = list(self.substrings)
+        suffixes = []
+        if self.path:
+            with open(self.path) as rules:
+                for rule in rules:
+                    rule = rule.strip().lower()
+                    if not rule or rule.startswith('#'):
+                        continue
+                    kind, sep, value = rule.partition(':')
+                    if sep and kind == 'suffix':
+                        suffixes.append(value.strip().strip('.'))
+                    elif sep and kind == 'substring':
+                        substrings.append(value.strip())
+                    else:
+                        substrings.append(rule)
+        # the rules are swapped at once, a match in progress keeps the
+        # previous ones
+        self.rules = (self._automaton([x for x in substrings if x]), self._trie([x for x in suffixes if x]))
+        return len(substrings) + len(suffixes)
+
+    def match(self, rrname):
+        """Return the rule matching the rrname (and count a hit) or None."""
+        (goto, fail, out), trie = self.rules
+        rule = None
+        node = 0
+        for ch in rrname:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node] is not None:
+                rule = f'substring:{out[node]}'
+                break
+        if rule is None and trie:
+            node = trie
+            for label in reversed(rrname.split('.')):
+                node = node.get(label)
+                if node is None:
+                    break
+                if None in node:
+                    rule = f'suffix:{node[None]}'
+                    break
+        if rule is not None:
+            self.hits[rule] += 1
+        return rule
+
+    def _automaton(self, patterns):
+        goto = [{}]
+        fail = [0]
+        out = [None]
+        for pattern in patterns:
+            node = 0
+            for ch in pattern:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    goto.append({})
+                    fail.append(0)
+                    out.append(None)
+                    nxt = len(goto) - 1
+                    goto[node][ch] = nxt
+                node = nxt
+            if out[node] is None:
+                out[node] = pattern
+        nodes = deque(goto[0].values())
+        while nodes:
+            node = nodes.popleft()
+            for ch, nxt in goto[node].items():
+                nodes.append(nxt)
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fallback = goto[f].get(ch, 0)
+                fail[nxt] = fallback if fallback != nxt else 0
+                # a node also matches the patterns ending at its fallback
+                if out[nxt] is None:
+                    out[nxt] = out[fail[nxt]]
+        return goto, fail, out
+
+    def _trie(self, zones):
+        trie = {}
+        for zone in zones:
+            node = trie
+            for label in reversed(zone.split('.')):
+                node = node.setdefault(label, {})
+            node[None] = zone
+        return trie
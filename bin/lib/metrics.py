@@ -0,0 +1,135 @@
+#
+# Prometheus metrics of the Passive DNS ingestors, importers and server.
+#
+# This software is part of the D4 project.
+#
+# The software is released under the GNU Affero General Public version 3.
+#
+# Copyright (c) Computer Incident Response Center Luxembourg (CIRCL)
+
+# The metrics are updated once per batch or per request, and the
+# counters already kept by the code (exclusion hits, parse errors, queue
+# depth, cache statistics) are only read when scraped. Without the
+# prometheus_client module all the updates are no-ops.
+
+import time
+
+try:
+    import prometheus_client
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+
+enabled = prometheus_client is not None
+
+
+class _Noop:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def set_function(self, f):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def _metric(kind=None, name=None, documentation=None, labels=(), **kwargs):
+    if not enabled:
+        return _Noop()
+    return getattr(prometheus_client, kind)(name, documentation, labels, **kwargs)
+
+
+BATCH_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+RECORDS = _metric('Counter', 'pdns_records_total', 'Passive DNS records written', ['source'])
+SKIPPED = _metric('Counter', 'pdns_records_skipped_total', 'Records not written (invalid, unknown type or excluded)', ['source'])
+STAGE_SECONDS = _metric(
+    'Histogram', 'pdns_stage_seconds', 'Time spent per batch in each stage', ['stage'], buckets=BATCH_BUCKETS
+)
+REDIS_COMMANDS = _metric('Counter', 'pdns_redis_commands_total', 'Redis commands sent in pipelines', ['operation'])
+REDIS_SECONDS = _metric(
+    'Histogram', 'pdns_redis_seconds', 'Latency of the Redis pipelines', ['operation'], buckets=BATCH_BUCKETS
+)
+QUEUE_DEPTH = _metric('Gauge', 'pdns_queue_depth', 'Entries waiting in a queue', ['queue'])
+REQUEST_SECONDS = _metric('Histogram', 'pdns_http_request_seconds', 'Latency of the HTTP requests', ['endpoint'])
+RESULT_RECORDS = _metric(
+    'Histogram', 'pdns_http_result_records', 'Records returned per HTTP request', ['endpoint'], buckets=SIZE_BUCKETS
+)
+
+
+class _Collector:
+    # metrics computed from existing counters when scraped
+    def __init__(self, family=None, name=None, documentation=None, label=None, values=None):
+        self.family = family
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.values = values
+
+    def collect(self):
+        metric = self.family(self.name, self.documentation, labels=[self.label] if self.label else None)
+        values = self.values()
+        if self.label:
+            for key, value in values.items():
+                metric.add_metric([str(key)], value)
+        else:
+            metric.add_metric([], values)
+        yield metric
+
+
+def register_counter(name=None, documentation=None, label=None, values=None):
+    """Export the values returned by values() (a dict by label value, or a
+    number without label) as a counter."""
+    if enabled:
+        prometheus_client.REGISTRY.register(_Collector(CounterMetricFamily, name, documentation, label, values))
+
+
+def register_gauge(name=None, documentation=None, label=None, values=None):
+    """Same as register_counter for a gauge."""
+    if enabled:
+        prometheus_client.REGISTRY.register(_Collector(GaugeMetricFamily, name, documentation, label, values))
+
+
+def execute(pipe=None, operation=None):
+    """Execute a pipeline and account its commands and latency."""
+    commands = len(pipe)
+    start = time.perf_counter()
+    try:
+        return pipe.execute()
+    finally:
+        REDIS_SECONDS.labels(operation).observe(time.perf_counter() - start)
+        REDIS_COMMANDS.labels(operation).inc(commands)
+
+
+async def execute_async(pipe=None, operation=None):
+    """execute() for the asyncio pipelines."""
+    commands = len(pipe)
+    start = time.perf_counter()
+    try:
+        return await pipe.execute()
+    finally:
+        REDIS_SECONDS.labels(operation).observe(time.perf_counter() - start)
+        REDIS_COMMANDS.labels(operation).inc(commands)
+
+
+def start_server(port=None):
+    """Serve /metrics on port, nothing is done for a port of 0 or None."""
+    if not port:
+        return False
+    if not enabled:
+        raise RuntimeError('the prometheus_client module is required for the metrics')
+    prometheus_client.start_http_server(port)
+    return True
+
+
+def exposition():
+    """Return the content type and the body of a /metrics response."""
+    return prometheus_client.CONTENT_TYPE_LATEST, prometheus_client.generate_latest()
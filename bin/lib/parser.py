@@ -0,0 +1,88 @@
+#
+# Parsers of the passivedns (https://github.com/gamelinux/passivedns) format
+# as received from the D4 analyzer queues.
+#
+# This software is part of the D4 project.
+#
+# The software is released under the GNU Affero General Public version 3.
+#
+# Copyright (c) 2019 Alexandre Dulaunoy - a@foo.be
+# Copyright (c) Computer Incident Response Center Luxembourg (CIRCL)
+
+from collections import Counter
+
+
+def process_format_passivedns(line=None, dnstype=None):
+    # log line example
+    # timestamp||ip-src||ip-dst||class||q||type||v||ttl||count
+    # 1548624738.280922||192.168.1.12||8.8.8.8||IN||www-google-analytics.l.google.com.||AAAA||2a00:1450:400e:801::200e||299||12
+    vkey = ['timestamp','ip-src','ip-dst','class','q','type','v','ttl','count']
+    record = {}
+    if line is None or line == '':
+        return False
+    v = line.split("||")
+    i = 0
+    for r in v:
+        # trailing dot is removed and avoid case sensitivity
+        if i == 4 or i == 6:
+            r = r.lower().strip('.')
+        # timestamp is just epoch - second precision is only required
+        if i == 0:
+            r = r.split('.')[0]
+        record[vkey[i]] = r
+        # replace DNS type with the known DNS record type value
+        if i == 5:
+            record[vkey[i]] = dnstype[r]
+        i = i + 1
+    return record
+
+
+def parse_passivedns(lines=None, dnstype=None):
+    """Parse a batch of raw lines (bytes) popped from a D4 queue.
+
+    Returns the list of parsed records as (timestamp, class, rrname, type,
+    rdata, ttl) tuples, the type being the numeric value of the DNS type,
+    and a Counter of the malformed lines by reason (encoding, fields,
+    timestamp, type, rrname).
+    """
+    records = []
+    errors = Counter()
+    if not lines:
+        return records, errors
+    try:
+        decoded = b'\n'.join(lines).decode('utf-8').split('\n')
+    except UnicodeDecodeError:
+        decoded = []
+        for line in lines:
+            try:
+                decoded.append(line.decode('utf-8'))
+            except UnicodeDecodeError:
+                errors['encoding'] += 1
+
+    append = records.append
+    getdnstype = dnstype.get
+    for line in decoded:
+        fields = line.strip().split('||')
+        if len(fields) != 9:
+            errors['fields'] += 1
+            continue
+        timestamp, _, _, rrclass, rrname, rrtype, rdata, ttl, _ = fields
+        # timestamp is just epoch - second precision is only required
+        timestamp = timestamp.split('.', 1)[0]
+        if not timestamp.isdigit():
+            errors['timestamp'] += 1
+            continue
+        rrtype = getdnstype(rrtype)
+        if rrtype is None:
+            errors['type'] += 1
+            continue
+        # trailing dot is removed and avoid case sensitivity
+        rrname = rrname.lower().strip('.')
+        if not rrname:
+            errors['rrname'] += 1
+            continue
+        rdata = rdata.lower().strip('.')
+        if rrtype == '16':
+            rdata = rdata.replace('"', '', 1)
+        append((timestamp, rrclass, rrname, rrtype, rdata, ttl))
+    return records, errors
@@ -0,0 +1,79 @@
+#
+# Statistics of the Passive DNS ingestors and importers.
+#
+# This software is part of the D4 project.
+#
+# The software is released under the GNU Affero General Public version 3.
+#
+# Copyright (c) Computer Incident Response Center Luxembourg (CIRCL)
+
+import time
+from collections import Counter
+
+
+class StatsCollector:
+    """Count the statistics in memory and flush them to Redis periodically.
+
+    The keys are the ones read by the COF server /info:
+
+        stats:processed  number of records processed
+        stats:sensors    zset of the records processed by sensor
+        sensors:seen     set of the sensors seen
+        dist:ttl, dist:class, dist:type  distribution hashes
+
+    With a bucket size (in seconds), the records processed are also
+    counted by time bucket of their processing in the stats:timeline hash
+    (and stats:timeline:<sensor> for the records with a sensor), the field
+    being the start of the bucket.
+    """
+
+    def __init__(self, r, interval=5, bucket=0):
+        self.r = r
+        self.interval = interval
+        self.bucket = bucket
+        # the distributions are updated directly by the ingestors
+        self.dist = {'dist:ttl': Counter(), 'dist:class': Counter(), 'dist:type': Counter()}
+        self.processed = 0
+        self.sensors = Counter()
+        # (sensor or None, bucket start) -> records
+        self.timeline = Counter()
+        self.last_flush = time.monotonic()
+
+    def add(self, records=0, sensors=None):
+        """Count records processed, sensors maps sensors to their records."""
+        self.processed += records
+        if sensors:
+            self.sensors.update(sensors)
+        if self.bucket:
+            start = int(time.time()) // self.bucket * self.bucket
+            self.timeline[(None, start)] += records
+            for sensor, count in (sensors or {}).items():
+                self.timeline[(sensor, start)] += count
+
+    def due(self):
+        return time.monotonic() - self.last_flush >= self.interval
+
+    def flush(self, pipe=None):
+        """Write the counters, in pipe when given (the caller executes it)
+        or in a pipeline of their own."""
+        self.last_flush = time.monotonic()
+        execute = pipe is None
+        if execute:
+            pipe = self.r.pipeline(transaction=False)
+        for hkey, counter in self.dist.items():
+            for field, count in counter.items():
+                pipe.hincrby(hkey, field, amount=count)
+            counter.clear()
+        if self.processed:
+            pipe.incrby('stats:processed', amount=self.processed)
+            self.processed = 0
+        if self.sensors:
+            pipe.sadd('sensors:seen', *self.sensors)
+            for sensor, count in self.sensors.items():
+                pipe.zincrby('stats:sensors', count, sensor)
+            self.sensors.clear()
+        for (sensor, start), count in self.timeline.items():
+            pipe.hincrby('stats:timeline' if sensor is None else f'stats:timeline:{sensor}', start, amount=count)
+        self.timeline.clear()
+        if execute and len(pipe):
+            pipe.execute()
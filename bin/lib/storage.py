@@ -0,0 +1,342 @@
+#
+# Storage helpers shared by the Passive DNS ingestors and importers.
+#
+# This software is part of the D4 project.
+#
+# The software is released under the GNU Affero General Public version 3.
+#
+# Copyright (c) Computer Incident Response Center Luxembourg (CIRCL)
+
+import ipaddress
+
+# Two layouts are available for the first-seen, last-seen and count of
+# a (rrname, rdata, type) tuple:
+#
+# keys: one key for each of them
+#   s:<rrname>:<rdata>:<type>, l:<rrname>:<rdata>:<type>, o:<rrname>:<rdata>:<type>
+# hash: a single <first>:<last>:<count> field grouped under the rrname
+#   m:<rrname>:<type> <rdata> -> <first>:<last>:<count>
+#
+# The r:<rrname>:<type> and v:<rdata>:<type> sets are used by both layouts.
+#
+# With the retention index, each tuple is also added as <rrname>:<rdata>
+# to the ret:<type>:<bucket> set of the time bucket of its last-seen, the
+# sets being listed in the ret:buckets zset scored by the bucket start.
+# pdns-retention.py removes the tuples of the buckets older than the
+# horizon of their type.
+#
+# Secondary indexes, enabled in the [index] section of analyzer.conf:
+#
+# names: idx:names zset scored 0 of the rrnames with their labels reversed
+#        (www.example.com is com.example.www), the subdomains of a zone are
+#        a ZRANGEBYLEX away
+# ips: the rdata of the A records in the idx:ipv4 zset scored by the
+#      address as an integer, the ones of the AAAA records in the idx:ipv6
+#      zset scored 0 as <32 hex digits address>:<rdata>, both ordered by
+#      address for the CIDR queries
+# time: the tr:<rrname>:<type> zset of the rdata and the tv:<rdata>:<type>
+#       zset of the rrnames, scored by last-seen, for the queries limited
+#       to a time window
+# types: the rt:<rrname> and vt:<rdata> bitmaps of the types seen, the bit
+#        of the type value being set, a lookup only reads the r: and v:
+#        sets of these types
+LAYOUTS = ['keys', 'hash']
+INDEXES = ['names', 'ips', 'time', 'types']
+NAMES_INDEX = 'idx:names'
+IPV4_INDEX = 'idx:ipv4'
+IPV6_INDEX = 'idx:ipv6'
+
+# Upsert of a single (rrname, rdata, type) tuple executed server-side
+# to avoid the read-modify-write round trips and to make concurrent
+# ingestors safe.
+#
+# KEYS[1] r:<rrname>:<type>
+# KEYS[2] v:<rdata>:<type>
+# KEYS[3] s:<rrname>:<rdata>:<type> (first seen)
+# KEYS[4] l:<rrname>:<rdata>:<type> (last seen)
+# KEYS[5] o:<rrname>:<rdata>:<type> (occurrences)
+#
+# ARGV[1] rrname
+# ARGV[2] rdata
+# ARGV[3] first seen timestamp
+# ARGV[4] last seen timestamp
+# ARGV[5] count
+# ARGV[6] 1 if the count replaces the stored one, 0 if it is added
+# ARGV[7] expiration in seconds (0 for none)
+# ARGV[8] start of the last-seen bucket ('' without retention index), the
+#         ret:<type>:<bucket> set and the ret:buckets zset are then the
+#         last two keys
+# ARGV[9] 1 with the time index, the tr:<rrname>:<type> and
+#         tv:<rdata>:<type> zsets are then the two keys following the
+#         ones of the layout, scored with the last-seen of the tuple
+UPSERT_LUA = """
+redis.call('SADD', KEYS[1], ARGV[2])
+redis.call('SADD', KEYS[2], ARGV[1])
+-- first-seen is the minimum as in the hash layout, the records of an
+-- import are not in time order
+local first = tonumber(redis.call('GET', KEYS[3]))
+if first == nil or first > tonumber(ARGV[3]) then
+    redis.call('SET', KEYS[3], ARGV[3])
+end
+local last = tonumber(redis.call('GET', KEYS[4]))
+if last == nil or last < tonumber(ARGV[4]) then
+    last = tonumber(ARGV[4])
+    redis.call('SET', KEYS[4], ARGV[4])
+end
+if ARGV[6] == '1' then
+    redis.call('SET', KEYS[5], ARGV[5])
+else
+    redis.call('INCRBY', KEYS[5], ARGV[5])
+end
+local expiration = tonumber(ARGV[7])
+if expiration > 0 then
+    for i = 1, 5 do
+        redis.call('EXPIRE', KEYS[i], expiration)
+    end
+end
+if ARGV[9] == '1' then
+    redis.call('ZADD', KEYS[6], last, ARGV[2])
+    redis.call('ZADD', KEYS[7], last, ARGV[1])
+end
+if ARGV[8] ~= '' then
+    redis.call('SADD', KEYS[#KEYS - 1], ARGV[1] .. ':' .. ARGV[2])
+    redis.call('ZADD', KEYS[#KEYS], ARGV[8], KEYS[#KEYS - 1])
+end
+return 1
+"""
+
+# Same upsert for the hash layout, KEYS[3] is m:<rrname>:<type> and the
+# arguments are the same. The expiration applies to the whole hash.
+UPSERT_HASH_LUA = """
+redis.call('SADD', KEYS[1], ARGV[2])
+redis.call('SADD', KEYS[2], ARGV[1])
+local first = tonumber(ARGV[3])
+local last = tonumber(ARGV[4])
+local count = tonumber(ARGV[5])
+local stored = redis.call('HGET', KEYS[3], ARGV[2])
+-- a malformed stored value is replaced instead of failing the pipeline
+local sfirst, slast, scount
+if stored then
+    sfirst, slast, scount = string.match(stored, '^(%-?%d+):(%-?%d+):(%-?%d+)$')
+end
+if sfirst then
+    first = math.min(first, tonumber(sfirst))
+    last = math.max(last, tonumber(slast))
+    if ARGV[6] ~= '1' then
+        count = count + tonumber(scount)
+    end
+end
+redis.call('HSET', KEYS[3], ARGV[2], string.format('%d:%d:%d', first, last, count))
+local expiration = tonumber(ARGV[7])
+if expiration > 0 then
+    for i = 1, 3 do
+        redis.call('EXPIRE', KEYS[i], expiration)
+    end
+end
+if ARGV[9] == '1' then
+    redis.call('ZADD', KEYS[4], last, ARGV[2])
+    redis.call('ZADD', KEYS[5], last, ARGV[1])
+end
+if ARGV[8] ~= '' then
+    redis.call('SADD', KEYS[#KEYS - 1], ARGV[1] .. ':' .. ARGV[2])
+    redis.call('ZADD', KEYS[#KEYS], ARGV[8], KEYS[#KEYS - 1])
+end
+return 1
+"""
+
+# Removal of a tuple if its last-seen is older than ARGV[3], a tuple seen
+# again in the meantime is kept. The keys and the ARGV[1] rrname and
+# ARGV[2] rdata are the ones of the upsert. Returns 1 if removed, 0 if
+# kept or already gone.
+DELETE_LUA = """
+local last = tonumber(redis.call('GET', KEYS[4]))
+if last ~= nil and last >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('SREM', KEYS[1], ARGV[2])
+redis.call('SREM', KEYS[2], ARGV[1])
+return redis.call('DEL', KEYS[3], KEYS[4], KEYS[5]) > 0 and 1 or 0
+"""
+
+DELETE_HASH_LUA = """
+local stored = redis.call('HGET', KEYS[3], ARGV[2])
+if stored then
+    local last = tonumber(string.match(stored, '^%-?%d+:(%-?%d+):'))
+    if last and last >= tonumber(ARGV[3]) then
+        return 0
+    end
+    redis.call('HDEL', KEYS[3], ARGV[2])
+end
+redis.call('SREM', KEYS[1], ARGV[2])
+redis.call('SREM', KEYS[2], ARGV[1])
+return stored and 1 or 0
+"""
+
+
+def retention_bucket(config=None):
+    """Return the size of the last-seen buckets of the retention index
+    configured in analyzer.conf, 0 when the index is not used."""
+    if config.get('retention', 'mode', fallback='expire') != 'index':
+        return 0
+    return config.getint('retention', 'bucket', fallback=86400)
+
+
+def enabled_indexes(config=None):
+    """Return the set of secondary indexes enabled in analyzer.conf.
+
+    The indexes require the retention index, only pdns-retention.py
+    removes their entries, the expired records would leave them behind.
+    """
+    if not retention_bucket(config):
+        return set()
+    return {index for index in INDEXES if config.getboolean('index', index, fallback=False)}
+
+
+def ignored_indexes_warning(config=None):
+    """Return the warning to log when indexes are enabled in analyzer.conf
+    without the retention index, None otherwise."""
+    if retention_bucket(config):
+        return None
+    ignored = [index for index in INDEXES if config.getboolean('index', index, fallback=False)]
+    if not ignored:
+        return None
+    return 'The {} indexes of analyzer.conf are ignored, the indexes require mode = index in [retention]'.format(
+        ', '.join(ignored)
+    )
+
+
+def bitmap_types(bitmap=None):
+    """Return the set of type values set in a types bitmap, the bit 0
+    being the most significant bit of the first byte as for SETBIT."""
+    return {
+        i * 8 + bit
+        for i, byte in enumerate(bitmap)
+        if byte
+        for bit in range(8)
+        if byte & (0x80 >> bit)
+    }
+
+
+def reverse_name(name=None):
+    return '.'.join(reversed(name.split('.')))
+
+
+def ip_index(rdata=None, rtype=None):
+    """Return the (key, member, score) entry of an A or AAAA rdata in the
+    IP index, None for the other types and the invalid addresses."""
+    rtype = str(rtype)
+    if rtype != '1' and rtype != '28':
+        return None
+    try:
+        ip = ipaddress.ip_address(rdata)
+    except ValueError:
+        return None
+    if ip.version == 4:
+        return IPV4_INDEX, rdata, int(ip)
+    return IPV6_INDEX, f'{int(ip):032x}:{rdata}', 0
+
+
+class Storage:
+    def __init__(self, r, layout='keys', bucket=0, indexes=()):
+        if layout not in LAYOUTS:
+            raise ValueError(f'unknown storage layout {layout}')
+        self.r = r
+        self.layout = layout
+        # size of the last-seen buckets of the retention index, 0 for none
+        self.bucket = bucket
+        self.indexes = set(indexes)
+        if layout == 'hash':
+            self.upsert_script = r.register_script(UPSERT_HASH_LUA)
+            self.delete_script = r.register_script(DELETE_HASH_LUA)
+        else:
+            self.upsert_script = r.register_script(UPSERT_LUA)
+            self.delete_script = r.register_script(DELETE_LUA)
+
+    def _keys(self, rrname, rdata, rtype):
+        keys = [f'r:{rrname}:{rtype}', f'v:{rdata}:{rtype}']
+        if self.layout == 'hash':
+            keys.append(f'm:{rrname}:{rtype}')
+        else:
+            keys.extend([
+                f's:{rrname}:{rdata}:{rtype}',
+                f'l:{rrname}:{rdata}:{rtype}',
+                f'o:{rrname}:{rdata}:{rtype}',
+            ])
+        return keys
+
+    def upsert(self, rrname, rdata, rtype, first, last, count=1, setcount=False, expiration=None, pipe=None):
+        """Add or update a Passive DNS record.
+
+        The call is queued when a pipeline is given, the script is then
+        loaded (if required) and executed with the pipeline.
+        """
+        keys = self._keys(rrname, rdata, rtype)
+        args = [rrname, rdata, int(first), int(last), count, 1 if setcount else 0, int(expiration or 0)]
+        timed = 'time' in self.indexes
+        if timed:
+            keys.extend([f'tr:{rrname}:{rtype}', f'tv:{rdata}:{rtype}'])
+        if self.bucket:
+            bucket = int(last) // self.bucket * self.bucket
+            keys.extend([f'ret:{rtype}:{bucket}', 'ret:buckets'])
+            args.append(bucket)
+        else:
+            args.append('')
+        args.append(1 if timed else 0)
+        client = pipe if pipe is not None else self.r
+        result = self.upsert_script(keys=keys, args=args, client=client)
+        if 'names' in self.indexes:
+            client.zadd(NAMES_INDEX, {reverse_name(rrname): 0})
+        if 'ips' in self.indexes:
+            entry = ip_index(rdata, rtype)
+            if entry is not None:
+                client.zadd(entry[0], {entry[1]: entry[2]})
+        if 'types' in self.indexes and str(rtype).isdigit():
+            client.setbit(f'rt:{rrname}', int(rtype), 1)
+            client.setbit(f'vt:{rdata}', int(rtype), 1)
+        return result
+
+    def delete(self, rrname, rdata, rtype, before, pipe=None):
+        """Remove a Passive DNS record unless it was seen since before."""
+        keys = self._keys(rrname, rdata, rtype)
+        return self.delete_script(keys=keys, args=[rrname, rdata, int(before)], client=pipe if pipe is not None else self.r)
+
+    def read(self, pipe, tuples):
+        """Queue in the pipeline the reads of (rrname, rdata, type) tuples.
+
+        The results of the pipeline are decoded with decode().
+        """
+        if self.layout == 'hash':
+            for rrname, rdata, rtype in tuples:
+                pipe.hget(f'm:{rrname}:{rtype}', rdata)
+        else:
+            keys = []
+            for rrname, rdata, rtype in tuples:
+                for prefix in ('s', 'l', 'o'):
+                    keys.append(f'{prefix}:{rrname}:{rdata}:{rtype}')
+            pipe.mget(keys)
+        return pipe
+
+    def decode(self, results):
+        """Return a (first, last, count) tuple (or None if unknown) for each
+        of the tuples read with read().
+        """
+        seen = []
+        if self.layout == 'hash':
+            for value in results:
+                if value is None:
+                    seen.append(None)
+                    continue
+                seen.append(tuple(int(x) for x in value.split(b':')))
+            return seen
+        values = results[0] if results else []
+        for i in range(0, len(values), 3):
+            firstseen, lastseen, count = values[i:i + 3]
+            if firstseen is None:
+                seen.append(None)
+                continue
+            seen.append((
+                int(firstseen),
+                int(lastseen) if lastseen is not None else None,
+                int(count) if count is not None else None,
+            ))
+        return seen
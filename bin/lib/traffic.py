@@ -0,0 +1,108 @@
+#
+# Synthetic Passive DNS traffic for the benchmarks.
+#
+# This software is part of the D4 project.
+#
+# The software is released under the GNU Affero General Public version 3.
+#
+# Copyright (c) Computer Incident Response Center Luxembourg (CIRCL)
+
+import itertools
+import json
+import random
+
+# share of each type in the generated records
+TYPES = [('A', 60), ('AAAA', 20), ('CNAME', 10), ('TXT', 5), ('NS', 5)]
+
+WORDS = ['www', 'mail', 'api', 'cdn', 'static', 'login', 'update', 'img', 'm', 'dev', 'shop', 'news']
+TLDS = ['com', 'net', 'org', 'lu', 'de', 'fr', 'io', 'eu']
+
+
+def zipf_weights(n=None, s=1.1):
+    """Cumulative weights of n ranks following a Zipf law of exponent s."""
+    return list(itertools.accumulate(1 / (rank**s) for rank in range(1, n + 1)))
+
+
+class Traffic:
+    """Generator of DNS answers with Zipf distributed name and IP popularity.
+
+    The same seed gives the same names and IPs, a benchmark can query the
+    names written by a previous run.
+    """
+
+    def __init__(self, names=100000, ips=50000, s=1.1, seed=0):
+        self.random = random.Random(seed)
+        rnd = self.random
+        self.names = []
+        for i in range(names):
+            zone = f'{rnd.choice(WORDS)}{i // 10}.{rnd.choice(TLDS)}'
+            self.names.append(f'{rnd.choice(WORDS)}{i % 10}.{zone}')
+        self.ipv4 = [
+            f'{rnd.randint(1, 223)}.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}' for _ in range(ips)
+        ]
+        self.ipv6 = [f'2001:db8:{rnd.randint(0, 0xffff):x}::{rnd.randint(1, 0xffff):x}' for _ in range(ips)]
+        self.name_weights = zipf_weights(names, s)
+        self.ip_weights = zipf_weights(ips, s)
+        self.types = [t for t, _ in TYPES]
+        self.type_weights = list(itertools.accumulate(w for _, w in TYPES))
+
+    def sample_names(self, n=None):
+        return self.random.choices(self.names, cum_weights=self.name_weights, k=n)
+
+    def answers(self, n=None, start=1600000000, rate=1000):
+        """Return n (timestamp, rrname, type, rdata, ttl) answers, rate
+        answers per second from start."""
+        rnd = self.random
+        names = self.sample_names(n)
+        types = rnd.choices(self.types, cum_weights=self.type_weights, k=n)
+        ips = rnd.choices(range(len(self.ipv4)), cum_weights=self.ip_weights, k=n)
+        answers = []
+        for i, (rrname, rrtype, ip) in enumerate(zip(names, types, ips)):
+            if rrtype == 'A':
+                rdata = self.ipv4[ip]
+            elif rrtype == 'AAAA':
+                rdata = self.ipv6[ip]
+            elif rrtype == 'CNAME':
+                rdata = f'edge{ip % 100}.cdn.example.net'
+            elif rrtype == 'TXT':
+                rdata = f'"v=spf1 ip4:{self.ipv4[ip]} -all"'
+            else:
+                rdata = f'ns{ip % 4}.{rrname.split(".", 1)[1]}'
+            answers.append((start + i // rate, rrname, rrtype, rdata, rnd.choice((60, 300, 3600, 86400))))
+        return answers
+
+    def passivedns_lines(self, n=None):
+        """Return n passivedns lines (bytes) as popped from a D4 queue."""
+        return [
+            f'{timestamp}.{i % 1000000:06d}||192.168.1.12||8.8.8.8||IN||{rrname}.||{rrtype}||{rdata}||{ttl}||1'.encode()
+            for i, (timestamp, rrname, rrtype, rdata, ttl) in enumerate(self.answers(n))
+        ]
+
+    def cof_records(self, n=None):
+        """Return n COF records, identical answers are counted once."""
+        records = {}
+        for timestamp, rrname, rrtype, rdata, _ in self.answers(n):
+            record = records.get((rrname, rrtype, rdata))
+            if record is None:
+                records[(rrname, rrtype, rdata)] = {
+                    'rrname': rrname,
+                    'rrtype': rrtype,
+                    'rdata': rdata,
+                    'time_first': timestamp,
+                    'time_last': timestamp,
+                    'count': 1,
+                    'sensor_id': 'benchmark',
+                }
+            else:
+                record['time_last'] = timestamp
+                record['count'] += 1
+        return list(records.values())
+
+    def write_ndjson(self, path=None, n=None):
+        with open(path, 'w') as f:
+            for record in self.cof_records(n):
+                f.write(json.dumps(record) + '\n')
+
+    def write_json_array(self, path=None, n=None):
+        with open(path, 'w') as f:
+            json.dump(self.cof_records(n), f)
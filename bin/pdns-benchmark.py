@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+#
+# pdns-benchmark measures the parsing, the write path, the importers and
+# the query endpoints with synthetic Passive DNS traffic, against a local
+# Redis or kvrocks backend and COF server.
+#
+# This software is part of the D4 project.
+#
+# The software is released under the GNU Affero General Public version 3.
+#
+# Copyright (c) Computer Incident Response Center Luxembourg (CIRCL)
+
+
+import argparse
+import configparser
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+from lib.aggregate import Aggregator
+from lib.parser import parse_passivedns, process_format_passivedns
+from lib.storage import Storage, enabled_indexes, ignored_indexes_warning, retention_bucket
+from lib.traffic import Traffic
+
+SCENARIOS = ['parser', 'write', 'import', 'query']
+
+parser = argparse.ArgumentParser(description='Benchmark of the Passive DNS ingestion and query paths')
+parser.add_argument('--scenario', dest='scenarios', action='append', choices=SCENARIOS, help='Scenario to run (default: all)')
+parser.add_argument('--records', dest='records', type=int, default=100000, help='Number of generated records')
+parser.add_argument('--names', dest='names', type=int, default=100000, help='Number of distinct rrnames')
+parser.add_argument('--ips', dest='ips', type=int, default=50000, help='Number of distinct IP addresses')
+parser.add_argument('--zipf', dest='zipf', type=float, default=1.1, help='Exponent of the Zipf popularity of the names and IPs')
+parser.add_argument('--seed', dest='seed', type=int, default=0, help='Seed of the generator')
+parser.add_argument('--batch', dest='batch', type=int, default=1000, help='Number of records per batch of the write path')
+parser.add_argument('--queries', dest='queries', type=int, default=2000, help='Number of queries per endpoint')
+parser.add_argument('--concurrency', dest='concurrency', type=int, default=8, help='Number of concurrent queries')
+# the records are written to a database given explicitly, never to the
+# analyzer one from the environment
+parser.add_argument('--redis-host', dest='redishost', required=True, help='Host of the Redis or kvrocks backend used for the benchmark')
+parser.add_argument('--redis-port', dest='redisport', type=int, required=True, help='Port of the benchmark backend')
+parser.add_argument('--db', dest='db', type=int, required=True, help='Database of the benchmark backend, it must be empty')
+parser.add_argument('--server', dest='server', default='http://127.0.0.1:8400', help='URL of the COF server')
+parser.add_argument('--save', dest='save', help='Save the results as a baseline in this file')
+parser.add_argument('--compare', dest='compare', help='Compare the results with a saved baseline')
+parser.add_argument('--tolerance', dest='tolerance', type=float, default=10, help='Regression tolerance in percent')
+args = parser.parse_args()
+
+config = configparser.RawConfigParser()
+config.read('../etc/analyzer.conf')
+
+r = redis.Redis(host=args.redishost, port=args.redisport, db=args.db)
+store = Storage(
+    r, layout=config.get('storage', 'layout', fallback='keys'), bucket=retention_bucket(config), indexes=enabled_indexes(config)
+)
+if ignored_indexes_warning(config):
+    print(ignored_indexes_warning(config), file=sys.stderr)
+
+with open('../etc/records-type.json') as rtypefile:
+    rtype = json.load(rtypefile)
+
+dnstype = {}
+
+for v in rtype:
+    dnstype[(v['type'])] = v['value']
+
+traffic = Traffic(names=args.names, ips=args.ips, s=args.zipf, seed=args.seed)
+
+
+def percentile(values=None, p=None):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def latencies(values=None):
+    # in milliseconds
+    return {'p50_ms': percentile(values, 50) * 1000, 'p99_ms': percentile(values, 99) * 1000}
+
+
+def used_memory():
+    try:
+        info = r.info()
+    except redis.ResponseError:
+        return None, r.dbsize()
+    # kvrocks reports the disk usage instead of the memory
+    return info.get('used_memory', info.get('used_disk_size')), r.dbsize()
+
+
+def bench_parser():
+    lines = traffic.passivedns_lines(args.records)
+    start = time.perf_counter()
+    for line in lines:
+        process_format_passivedns(line=line.decode('utf-8').strip(), dnstype=dnstype)
+    legacy = time.perf_counter() - start
+    timings = []
+    start = time.perf_counter()
+    for i in range(0, len(lines), args.batch):
+        t = time.perf_counter()
+        parse_passivedns(lines=lines[i : i + args.batch], dnstype=dnstype)
+        timings.append(time.perf_counter() - t)
+    batch = time.perf_counter() - start
+    return {
+        'process_format_passivedns_lines_per_s': len(lines) / legacy,
+        'parse_passivedns_lines_per_s': len(lines) / batch,
+        **latencies(timings),
+    }
+
+
+def bench_write():
+    # the same path as pdns-ingestion: parsing, coalescing and pipelined
+    # upserts with the distribution stats
+    lines = traffic.passivedns_lines(args.records)
+    memory, keys = used_memory()
+    batch = Aggregator(max_entries=args.batch, window=3600)
+    timings = []
+    written = 0
+    start = time.perf_counter()
+    for i in range(0, len(lines), args.batch):
+        t = time.perf_counter()
+        records, _ = parse_passivedns(lines=lines[i : i + args.batch], dnstype=dnstype)
+        dist = {'dist:ttl': {}, 'dist:class': {}, 'dist:type': {}}
+        for timestamp, rrclass, rrname, rrtype, rdata, ttl in records:
+            batch.add(rrname, rdata, rrtype, int(timestamp))
+            for hkey, field in (('dist:ttl', ttl), ('dist:class', rrclass), ('dist:type', rrtype)):
+                dist[hkey][field] = dist[hkey].get(field, 0) + 1
+        aggregated, count = batch.drain()
+        pipe = r.pipeline(transaction=False)
+        for rrname, rdata, rrtype, first, last, occurrences in aggregated:
+            store.upsert(rrname, rdata, rrtype, first=first, last=last, count=occurrences, pipe=pipe)
+        for hkey in dist:
+            for field, value in dist[hkey].items():
+                pipe.hincrby(hkey, field, amount=value)
+        pipe.incrby('stats:processed', amount=count)
+        pipe.execute()
+        written += count
+        timings.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    after, afterkeys = used_memory()
+    results = {'records_per_s': written / elapsed, **latencies(timings), 'keys': afterkeys - keys}
+    if memory is not None and afterkeys > keys:
+        results['bytes_per_key'] = (after - memory) / (afterkeys - keys)
+    return results
+
+
+def run_importer(script=None, path=None, records=None):
+    # the importers write to the benchmark database as well
+    env = dict(
+        os.environ,
+        D4_ANALYZER_REDIS_HOST=args.redishost,
+        D4_ANALYZER_REDIS_PORT=str(args.redisport),
+        D4_ANALYZER_REDIS_DB=str(args.db),
+    )
+    start = time.perf_counter()
+    subprocess.run([sys.executable, script, '--file', path], check=True, capture_output=True, env=env)
+    return records / (time.perf_counter() - start)
+
+
+def bench_import():
+    results = {}
+    records = traffic.cof_records(args.records)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'records.ndjson')
+        with open(path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        results['import_cof_records_per_s'] = run_importer('pdns-import-cof.py', path, len(records))
+        path = os.path.join(tmp, 'records.json')
+        with open(path, 'w') as f:
+            json.dump(records, f)
+        results['import_records_per_s'] = run_importer('pdns-import.py', path, len(records))
+    return results
+
+
+def fetch(url=None):
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url) as response:
+            response.read()
+    except urllib.error.HTTPError as e:
+        # no record found is a valid answer
+        if e.code != 404:
+            raise
+    return time.perf_counter() - start
+
+
+def bench_endpoint(urls=None):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        timings = list(executor.map(fetch, urls))
+    return {'requests_per_s': len(urls) / (time.perf_counter() - start), **latencies(timings)}
+
+
+def bench_query():
+    # the names follow the same popularity as the written ones
+    names = traffic.sample_names(args.queries)
+    return {
+        'query': bench_endpoint([f'{args.server}/query/{name}' for name in names]),
+        'fquery': bench_endpoint([f'{args.server}/fquery/{name}' for name in names]),
+        'info': bench_endpoint([f'{args.server}/info'] * args.queries),
+    }
+
+
+def flatten(results=None, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(results=None, baseline=None):
+    """Return the metrics worse than the baseline by more than the tolerance."""
+    regressions = []
+    for key, value in results.items():
+        reference = baseline.get(key)
+        if not reference or key.endswith('.keys'):
+            continue
+        # throughputs must not drop, latencies and sizes must not grow
+        change = (value - reference) / reference * 100
+        worse = -change if key.endswith('_per_s') else change
+        print('{:<55} {:>14.2f} {:>14.2f} {:>+8.1f}%'.format(key, reference, value, change))
+        if worse > args.tolerance:
+            regressions.append(key)
+    return regressions
+
+
+scenarios = args.scenarios or SCENARIOS
+if ('write' in scenarios or 'import' in scenarios) and r.dbsize():
+    # synthetic records must never be mixed with real ones
+    print(
+        'Database {} of {}:{} is not empty, the write and import benchmarks need an empty database'.format(
+            args.db, args.redishost, args.redisport
+        ),
+        file=sys.stderr,
+    )
+    sys.exit(2)
+
+benchmarks = {'parser': bench_parser, 'write': bench_write, 'import': bench_import, 'query': bench_query}
+results = {}
+for scenario in scenarios:
+    print('Running the {} benchmark'.format(scenario), file=sys.stderr)
+    results[scenario] = benchmarks[scenario]()
+
+results = flatten(results)
+for key, value in results.items():
+    print('{:<55} {:>14.2f}'.format(key, value))
+
+if args.save:
+    with open(args.save, 'w') as f:
+        json.dump({'records': args.records, 'results': results}, f, indent=2)
+
+if args.compare:
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    print('\n{:<55} {:>14} {:>14} {:>9}'.format('metric', 'baseline', 'current', 'change'))
+    regressions = compare(results, baseline['results'])
+    if regressions:
+        print('Regressions: {}'.format(', '.join(regressions)))
+        sys.exit(1)
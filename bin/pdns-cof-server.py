@@ -18,12 +18,20 @@
 from datetime import date
 import tornado.escape
 import tornado.ioloop
+import tornado.iostream
 import tornado.web
 
+import asyncio
+import ipaddress
 import iptools
-import redis
+import redis.asyncio as redis
 import json
 import os
+import configparser
+
+from lib import metrics
+from lib.cache import ResultCache
+from lib.storage import IPV4_INDEX, IPV6_INDEX, NAMES_INDEX, Storage, bitmap_types, enabled_indexes, ignored_indexes_warning, reverse_name
 
 rrset = [
     {
@@ -670,8 +678,25 @@ rrset = [
 
 analyzer_redis_host = os.getenv('D4_ANALYZER_REDIS_HOST', '127.0.0.1')
 analyzer_redis_port = int(os.getenv('D4_ANALYZER_REDIS_PORT', 6400))
+analyzer_redis_db = int(os.getenv('D4_ANALYZER_REDIS_DB', 0))
+
+analyzer_redis_pool_size = int(os.getenv('D4_ANALYZER_REDIS_POOL_SIZE', 32))
+
+# handlers wait for a free connection when all of them are in use
+pool = redis.BlockingConnectionPool(
+    host=analyzer_redis_host,
+    port=analyzer_redis_port,
+    db=analyzer_redis_db,
+    max_connections=analyzer_redis_pool_size,
+)
+r = redis.StrictRedis(connection_pool=pool)
 
-r = redis.StrictRedis(host=analyzer_redis_host, port=analyzer_redis_port, db=0)
+config = configparser.RawConfigParser()
+config.read('../etc/analyzer.conf')
+store = Storage(r, layout=config.get('storage', 'layout', fallback='keys'))
+indexes = enabled_indexes(config)
+if ignored_indexes_warning(config):
+    print(ignored_indexes_warning(config), flush=True)
 
 rrset_supported = ['1', '2', '5', '15', '16', '28', '33', '46']
 expiring_type = ['16']
@@ -679,87 +704,392 @@ expiring_type = ['16']
 
 origin = "origin not configured"
 
+# results of /query and /fquery are kept in memory, a size of 0 disables the cache
+cache = ResultCache(
+    max_bytes=int(os.getenv('D4_ANALYZER_CACHE_SIZE', 64 * 1024 * 1024)),
+    ttl=int(os.getenv('D4_ANALYZER_CACHE_TTL', 300)),
+    negative_ttl=int(os.getenv('D4_ANALYZER_CACHE_NEGATIVE_TTL', 60)),
+)
 
-def getFirstSeen(t1=None, t2=None):
-    if t1 is None or t2 is None:
-        return False
-    rec = f's:{t1.lower()}:{t2.lower()}'
-    for rr in rrset:
-        if (rr['Value']) is not None and rr['Value'] in rrset_supported:
-            qrec = f'{rec}:{rr["Value"]}'
-            recget = r.get(qrec)
-            if recget is not None:
-                return int(recget.decode(encoding='UTF-8'))
+metrics.register_counter(
+    'pdns_cache_requests_total',
+    'Lookups in the result cache',
+    'result',
+    lambda: {'hit': cache.hits, 'miss': cache.misses},
+)
+metrics.register_gauge('pdns_cache_bytes', 'Size of the result cache', None, lambda: cache.size)
+metrics.register_gauge('pdns_cache_entries', 'Entries in the result cache', None, lambda: len(cache.entries))
 
+# number of names resolved by each of the concurrent lookups
+query_chunk = 100
+# maximum number of queries of a POST /query/batch
+batch_max = int(os.getenv('D4_ANALYZER_BATCH_MAX', 100000))
+# sets with more members are walked with SSCAN instead of SMEMBERS
+scan_threshold = 200
+scan_count = 1000
 
-def getLastSeen(t1=None, t2=None):
-    if t1 is None or t2 is None:
-        return False
-    rec = f'l:{t1.lower()}:{t2.lower()}'
-    for rr in rrset:
-        if (rr['Value']) is not None and rr['Value'] in rrset_supported:
-            qrec = f'{rec}:{rr["Value"]}'
-            recget = r.get(qrec)
-            if recget is not None:
-                return int(recget.decode(encoding='UTF-8'))
 
+# supported record types in the order of the rrset table
+rrtypes = [
+    (rr['Value'], rr['Type'])
+    for rr in rrset
+    if (rr['Value']) is not None and rr['Value'] in rrset_supported
+]
 
-def getCount(t1=None, t2=None):
-    if t1 is None or t2 is None:
-        return False
-    rec = f'o:{t1.lower()}:{t2.lower()}'
-    for rr in rrset:
-        if (rr['Value']) is not None and rr['Value'] in rrset_supported:
-            qrec = f'{rec}:{rr["Value"]}'
-            recget = r.get(qrec)
-            if recget is not None:
-                return int(recget.decode(encoding='UTF-8'))
 
+async def typesOf(prefix=None, keys=None, types=None):
+    # types to probe for each key, narrowed by the rt: or vt: bitmaps of
+    # the types seen when the types index is enabled, a missing bitmap
+    # (records stored before the index) probes all of them
+    types = types or rrtypes
+    if 'types' not in indexes:
+        return [types] * len(keys)
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.get(f'{prefix}:{key}')
+    probes = []
+    for bitmap in await metrics.execute_async(pipe, 'types'):
+        if bitmap is None:
+            probes.append(types)
+            continue
+        seen = bitmap_types(bitmap)
+        probes.append([(value, rrtype) for value, rrtype in types if int(value) in seen])
+    return probes
 
-def getRecord(t=None):
-    if t is None:
+
+async def resolveRecords(tuples=None):
+    # tuples are (rrname, rdata, type value, type name), first-seen,
+    # last-seen and count of all of them are fetched in a single batch
+    if not tuples:
+        return []
+    pipe = r.pipeline(transaction=False)
+    store.read(pipe, [(t.lower(), rdata.lower(), value) for t, rdata, value, _ in tuples])
+    values = store.decode(await metrics.execute_async(pipe, 'records'))
+
+    rrfound = []
+    for (t, rdata, value, rrtype), seen in zip(tuples, values):
+        if seen is None:
+            continue
+        rrval = {}
+        rrval['time_first'], rrval['time_last'], rrval['count'] = seen
+        rrval['rrtype'] = rrtype
+        rrval['rrname'] = t
+        rrval['rdata'] = rdata
+        if origin:
+            rrval['origin'] = origin
+        rrfound.append(rrval)
+    return rrfound
+
+
+async def iterRecords(names=None, types=None):
+    # records of the names are yielded by batches, the small sets are
+    # fetched in a fixed number of pipelined batches while the large
+    # ones are walked with SSCAN
+    if names is None:
+        return
+    probes = await typesOf('rt', names, types)
+    pipe = r.pipeline(transaction=False)
+    for t, probe in zip(names, probes):
+        for value, _ in probe:
+            pipe.scard(f'r:{t}:{value}')
+    setsizes = iter(await metrics.execute_async(pipe, 'sizes'))
+
+    sets = []
+    largesets = []
+    for t, probe in zip(names, probes):
+        for value, rrtype in probe:
+            setsize = next(setsizes)
+            if setsize >= scan_threshold:
+                largesets.append((t, value, rrtype))
+            elif setsize > 0:
+                sets.append((t, value, rrtype))
+
+    if sets:
+        for t, value, _ in sets:
+            pipe.smembers(f'r:{t}:{value}')
+        tuples = []
+        for (t, value, rrtype), rs in zip(sets, await metrics.execute_async(pipe, 'members')):
+            for v in rs:
+                tuples.append((t, v.decode(encoding='UTF-8').strip(), value, rrtype))
+        yield await resolveRecords(tuples)
+
+    for t, value, rrtype in largesets:
+        tuples = []
+        async for v in r.sscan_iter(f'r:{t}:{value}', count=scan_count):
+            tuples.append((t, v.decode(encoding='UTF-8').strip(), value, rrtype))
+            if len(tuples) >= scan_count:
+                yield await resolveRecords(tuples)
+                tuples = []
+        if tuples:
+            yield await resolveRecords(tuples)
+
+
+async def iterRecordsInWindow(names=None, window=None, types=None):
+    # records of the names last seen in the time window, only the tuples
+    # of the window are read from the time index
+    low, high = lastSeenRange(window)
+    probes = await typesOf('rt', names, types)
+    pipe = r.pipeline(transaction=False)
+    for t, probe in zip(names, probes):
+        for value, _ in probe:
+            pipe.zrangebyscore(f'tr:{t}:{value}', low, high)
+    results = iter(await metrics.execute_async(pipe, 'window'))
+    tuples = []
+    for t, probe in zip(names, probes):
+        for value, rrtype in probe:
+            for v in next(results):
+                tuples.append((t, v.decode(encoding='UTF-8').strip(), value, rrtype))
+            if len(tuples) >= scan_count:
+                yield await resolveRecords(tuples)
+                tuples = []
+    if tuples:
+        yield await resolveRecords(tuples)
+
+
+async def iterAssociatedRecordsInWindow(rdata=None, window=None, types=None):
+    # names associated to a rdata during the time window
+    low, high = lastSeenRange(window)
+    (probe,) = await typesOf('vt', [rdata.lower()], types)
+    pipe = r.pipeline(transaction=False)
+    for value, _ in probe:
+        pipe.zrangebyscore(f'tv:{rdata.lower()}:{value}', low, high)
+    records = []
+    seen = set()
+    for rs in await metrics.execute_async(pipe, 'window'):
+        for v in rs:
+            name = v.decode(encoding='UTF-8')
+            if name not in seen:
+                seen.add(name)
+                records.append(name)
+    for i in range(0, len(records), scan_count):
+        yield records[i:i + scan_count]
+
+
+async def getRecords(names=None, types=None):
+    if names is None:
         return False
     rrfound = []
-    for rr in rrset:
-        if (rr['Value']) is not None and rr['Value'] in rrset_supported:
-            rec = f'r:{t}:{rr["Value"]}'
-            setsize = r.scard(rec)
-            if setsize < 200:
-                rs = r.smembers(rec)
-            else:
-                # TODO: improve with a new API end-point with SSCAN
-                # rs = r.srandmember(rec, number=300)
-                rs = False
-
-            if rs:
-                for v in rs:
-                    rrval = {}
-                    rdata = v.decode(encoding='UTF-8').strip()
-                    rrval['time_first'] = getFirstSeen(t1=t, t2=rdata)
-                    rrval['time_last'] = getLastSeen(t1=t, t2=rdata)
-                    if rrval['time_first'] is None:
-                        break
-                    rrval['count'] = getCount(t1=t, t2=rdata)
-                    rrval['rrtype'] = rr['Type']
-                    rrval['rrname'] = t
-                    rrval['rdata'] = rdata
-                    if origin:
-                        rrval['origin'] = origin
-                    rrfound.append(rrval)
+    async for records in iterRecords(names=names, types=types):
+        rrfound.extend(records)
     return rrfound
 
 
-def getAssociatedRecords(rdata=None):
-    if rdata is None:
+async def scanSets(prefix=None, cursor=None, limit=100, types=None, probe=None):
+    # walk the sets <prefix>:<type> of the types (all supported ones by
+    # default) with SSCAN, the cursor is <type>:<SSCAN cursor> and 0 when
+    # the walk is over, the types missing from probe are skipped
+    values = [value for value, _ in types or rrtypes]
+    start = 0
+    scan = 0
+    if cursor and cursor != '0':
+        ctype, _, ccursor = cursor.partition(':')
+        if ctype not in values or not ccursor.isdigit():
+            raise ValueError(f'invalid cursor {cursor}')
+        start = values.index(ctype)
+        scan = int(ccursor)
+    members = []
+    for i in range(start, len(values)):
+        if probe is not None and values[i] not in probe:
+            continue
+        while True:
+            scan, page = await r.sscan(f'{prefix}:{values[i]}', cursor=scan, count=limit)
+            members.extend((values[i], v.decode(encoding='UTF-8')) for v in page)
+            if scan == 0:
+                break
+            if len(members) >= limit:
+                return members, f'{values[i]}:{scan}'
+        if len(members) >= limit:
+            if i + 1 < len(values):
+                return members, f'{values[i + 1]}:0'
+            return members, '0'
+    return members, '0'
+
+
+async def scanNames(zone=None, cursor=None, limit=100):
+    # names below a zone are read from the reversed names index, the
+    # cursor is the last reversed name returned and 0 at the end
+    zone = zone.strip().strip('.').lower()
+    if not zone:
+        raise ValueError('empty zone')
+    prefix = f'{reverse_name(zone)}.'
+    if cursor and cursor != '0':
+        if not cursor.startswith(prefix):
+            raise ValueError(f'invalid cursor {cursor}')
+        start = f'({cursor}'
+    else:
+        start = f'[{prefix}'
+    # '/' follows '.', all the names of the zone sort before it
+    members = await r.zrangebylex(NAMES_INDEX, start, f'({prefix[:-1]}/', start=0, num=limit)
+    members = [m.decode(encoding='UTF-8') for m in members]
+    cursor = members[-1] if len(members) == limit else '0'
+    return [reverse_name(m) for m in members], cursor
+
+
+async def scanNetwork(network=None, cursor=None, limit=100):
+    # addresses of a network are read from the IP index in address order
+    # as (address, type value, type name) tuples, the cursor is the last
+    # entry returned and 0 at the end
+    first = int(network.network_address)
+    last = int(network.broadcast_address)
+    if network.version == 4:
+        start = first
+        if cursor and cursor != '0':
+            if not cursor.isdigit() or not first <= int(cursor) <= last:
+                raise ValueError(f'invalid cursor {cursor}')
+            start = f'({cursor}'
+        entries = await r.zrangebyscore(IPV4_INDEX, start, last, start=0, num=limit, withscores=True)
+        ips = [(m.decode(encoding='UTF-8'), '1', 'A') for m, _ in entries]
+        cursor = str(int(entries[-1][1])) if len(entries) == limit else '0'
+        return ips, cursor
+    start = f'[{first:032x}'
+    if cursor and cursor != '0':
+        address = cursor.split(':', 1)[0]
+        if len(address) != 32 or not f'{first:032x}' <= address <= f'{last:032x}':
+            raise ValueError(f'invalid cursor {cursor}')
+        start = f'({cursor}'
+    # ';' follows ':', all the entries of the last address sort before it
+    members = await r.zrangebylex(IPV6_INDEX, start, f'({last:032x};', start=0, num=limit)
+    members = [m.decode(encoding='UTF-8') for m in members]
+    ips = [(m.split(':', 1)[1], '28', 'AAAA') for m in members]
+    cursor = members[-1] if len(members) == limit else '0'
+    return ips, cursor
+
+
+async def iterNetworkRecords(ips=None):
+    # records of the addresses (of their A or AAAA type only) by batches
+    pipe = r.pipeline(transaction=False)
+    for ip, value, _ in ips:
+        pipe.smembers(f'v:{ip}:{value}')
+    tuples = []
+    for (ip, value, rrtype), names in zip(ips, await metrics.execute_async(pipe, 'members')):
+        for name in names:
+            tuples.append((name.decode(encoding='UTF-8'), ip, value, rrtype))
+            if len(tuples) >= scan_count:
+                yield await resolveRecords(tuples)
+                tuples = []
+    if tuples:
+        yield await resolveRecords(tuples)
+
+
+def parseNetwork(q=None):
+    try:
+        return ipaddress.ip_network(q.strip(), strict=False)
+    except ValueError:
+        raise ValueError(f'invalid network {q}')
+
+
+async def getRecordsPage(t=None, cursor=None, limit=100, types=None):
+    (probe,) = await typesOf('rt', [t], types)
+    members, cursor = await scanSets(
+        prefix=f'r:{t}', cursor=cursor, limit=limit, types=types, probe=[value for value, _ in probe]
+    )
+    rrtype = dict(rrtypes)
+    tuples = [(t, rdata.strip(), value, rrtype[value]) for value, rdata in members]
+    return await resolveRecords(tuples), cursor
+
+
+async def getAssociatedRecordsPage(rdata=None, cursor=None, limit=100, types=None):
+    (probe,) = await typesOf('vt', [rdata.lower()], types)
+    members, cursor = await scanSets(
+        prefix=f'v:{rdata.lower()}', cursor=cursor, limit=limit, types=types, probe=[value for value, _ in probe]
+    )
+    names = list(dict.fromkeys(name for _, name in members))
+    return names, cursor
+
+
+async def getRecord(t=None):
+    if t is None:
         return False
+    return await getRecords(names=[t])
+
+
+async def iterRecordsConcurrently(names=None, types=None):
+    # large lists of names are split and resolved concurrently, records
+    # are yielded as soon as the lookup of a chunk is over
+    if names is None:
+        return
+    chunks = [names[i:i + query_chunk] for i in range(0, len(names), query_chunk)]
+    for lookup in asyncio.as_completed([getRecords(names=chunk, types=types) for chunk in chunks]):
+        yield await lookup
+
+
+async def iterAssociatedRecords(rdata=None, types=None):
+    # names associated to a rdata are yielded by batches, large sets
+    # are walked with SSCAN
+    if rdata is None:
+        return
     rec = f'v:{rdata.lower()}'
+    (probe,) = await typesOf('vt', [rdata.lower()], types)
+    pipe = r.pipeline(transaction=False)
+    for value, _ in probe:
+        pipe.scard(f'{rec}:{value}')
+    setsizes = await metrics.execute_async(pipe, 'sizes')
+    for (value, _), setsize in zip(probe, setsizes):
+        if 0 < setsize < scan_threshold:
+            pipe.smembers(f'{rec}:{value}')
     records = []
-    for rr in rrset:
-        if (rr['Value']) is not None and rr['Value'] in rrset_supported:
-            qrec = f'{rec}:{rr["Value"]}'
-            if r.smembers(qrec):
-                for v in r.smembers(qrec):
-                    records.append(v.decode(encoding='UTF-8'))
+    seen = set()
+    for rs in await metrics.execute_async(pipe, 'members'):
+        for v in rs:
+            name = v.decode(encoding='UTF-8')
+            if name not in seen:
+                seen.add(name)
+                records.append(name)
+    if records:
+        yield records
+
+    for (value, _), setsize in zip(probe, setsizes):
+        if setsize < scan_threshold:
+            continue
+        records = []
+        async for v in r.sscan_iter(f'{rec}:{value}', count=scan_count):
+            records.append(v.decode(encoding='UTF-8'))
+            if len(records) >= scan_count:
+                yield records
+                records = []
+        if records:
+            yield records
+
+
+async def getAssociatedNames(ips=None, types=None):
+    # names associated to each rdata of a batch, the sets of all of them
+    # are read with the same pipelines, large ones with SSCAN
+    rdatas = [ip.lower() for ip in ips]
+    probes = await typesOf('vt', rdatas, types)
+    pipe = r.pipeline(transaction=False)
+    for rdata, probe in zip(rdatas, probes):
+        for value, _ in probe:
+            pipe.scard(f'v:{rdata}:{value}')
+    setsizes = iter(await metrics.execute_async(pipe, 'sizes'))
+
+    sets = []
+    largesets = []
+    for ip, rdata, probe in zip(ips, rdatas, probes):
+        for value, _ in probe:
+            setsize = next(setsizes)
+            if setsize >= scan_threshold:
+                largesets.append((ip, f'v:{rdata}:{value}'))
+            elif setsize > 0:
+                sets.append((ip, f'v:{rdata}:{value}'))
+
+    # dicts keep the names ordered and unique
+    associated = {ip: {} for ip in ips}
+    for _, key in sets:
+        pipe.smembers(key)
+    for (ip, _), rs in zip(sets, await metrics.execute_async(pipe, 'members')):
+        associated[ip].update(dict.fromkeys(v.decode(encoding='UTF-8').strip() for v in rs))
+    for ip, key in largesets:
+        async for v in r.sscan_iter(key, count=scan_count):
+            associated[ip][v.decode(encoding='UTF-8').strip()] = None
+    return associated
+
+
+async def getAssociatedRecords(rdata=None):
+    if rdata is None:
+        return False
+    records = []
+    async for names in iterAssociatedRecords(rdata=rdata):
+        records.extend(names)
     return records
 
 
@@ -773,22 +1103,28 @@ def RemDuplicate(d=None):
 def JsonQOF(rrfound=None, RemoveDuplicate=True):
     if rrfound is None:
         return False
-    rrqof = ""
-
     if RemoveDuplicate:
         rrfound = RemDuplicate(d=rrfound)
 
-    for rr in rrfound:
-        rrqof = rrqof + json.dumps(rr) + "\n"
-    return rrqof
+    return "".join(json.dumps(rr) + "\n" for rr in rrfound)
 
 
-class InfoHandler(tornado.web.RequestHandler):
-    def get(self):
-        stats = int(r.get("stats:processed"))
+class TimedHandler(tornado.web.RequestHandler):
+    # latency of the requests by endpoint
+    endpoint = None
+
+    def on_finish(self):
+        metrics.REQUEST_SECONDS.labels(self.endpoint).observe(self.request.request_time())
+
+
+class InfoHandler(TimedHandler):
+    endpoint = 'info'
+
+    async def get(self):
+        stats = int(await r.get("stats:processed"))
         response = {'version': 'git', 'software': 'analyzer-d4-passivedns'}
         response['stats'] = stats
-        sensors = r.zrevrange('stats:sensors', 0, -1, withscores=True)
+        sensors = await r.zrevrange('stats:sensors', 0, -1, withscores=True)
         rsensors = []
         for x in sensors:
             d = dict()
@@ -799,45 +1135,343 @@ class InfoHandler(tornado.web.RequestHandler):
         self.write(response)
 
 
-class QueryHandler(tornado.web.RequestHandler):
-    def get(self, q):
+# time window parameters of the COF draft, in seconds since the epoch
+time_parameters = ['time_first_after', 'time_first_before', 'time_last_after', 'time_last_before']
+
+
+def getTimeWindow(handler=None):
+    window = {}
+    for name in time_parameters:
+        value = handler.get_argument(name, None)
+        if value is None:
+            continue
+        try:
+            window[name] = int(value)
+        except ValueError:
+            raise tornado.web.HTTPError(400, f'invalid {name}')
+    return window or None
+
+
+def lastSeenRange(window=None):
+    # a record first seen after a date was also last seen after it
+    low = max(window.get('time_last_after', 0), window.get('time_first_after', 0))
+    high = window.get('time_last_before', '+inf')
+    return low or '-inf', high
+
+
+def filterTimeWindow(rrfound=None, window=None):
+    if window is None:
+        return rrfound
+    return [
+        rr
+        for rr in rrfound
+        if rr['time_first'] >= window.get('time_first_after', rr['time_first'])
+        and rr['time_first'] <= window.get('time_first_before', rr['time_first'])
+        and rr['time_last'] >= window.get('time_last_after', rr['time_last'])
+        and rr['time_last'] <= window.get('time_last_before', rr['time_last'])
+    ]
+
+
+def getTypes(handler=None):
+    # rrtype=MX or rrtype=A,AAAA, by type name or value, None for all
+    value = handler.get_argument('rrtype', None)
+    if value is None:
+        return None
+    byname = {rrtype.upper(): value for value, rrtype in rrtypes}
+    requested = set()
+    for t in value.split(','):
+        t = t.strip().upper()
+        if t not in byname and t not in byname.values():
+            raise tornado.web.HTTPError(400, f'unsupported rrtype {t}')
+        requested.add(byname.get(t, t))
+    # in the order of the rrset table, as the pagination cursors
+    return [(value, rrtype) for value, rrtype in rrtypes if value in requested]
+
+
+def getPagination(handler=None):
+    # pagination is requested with a cursor and/or a limit
+    cursor = handler.get_argument('cursor', None)
+    limit = handler.get_argument('limit', None)
+    if cursor is None and limit is None:
+        return None
+    try:
+        limit = int(limit) if limit is not None else 100
+    except ValueError:
+        raise tornado.web.HTTPError(400, 'invalid limit')
+    if limit <= 0:
+        raise tornado.web.HTTPError(400, 'invalid limit')
+    return cursor, limit
+
+
+class QOFHandler(TimedHandler):
+    # records are streamed as NDJSON (chunked) while they are resolved
+    def prepare(self):
+        self.set_header('Content-Type', 'application/x-ndjson')
+        self.records = 0
+        # the streamed response is kept for the cache while it is small
+        # enough, set before the parameters are checked for on_finish
+        self.cachebody = None
+        # the records out of the time window are never written
+        self.window = getTimeWindow(self)
+        # only the sets of the requested types are read
+        self.types = getTypes(self)
+        if not cache.enabled or self.request.method != 'GET':
+            return
+        cached = cache.get(self.request.uri)
+        if cached is not None:
+            body, headers = cached
+            self.records = body.count(b'\n')
+            for name, value in headers.items():
+                self.set_header(name, value)
+            self.finish(body)
+            return
+        self.cachebody = []
+        self.cachesize = 0
+
+    def log_exception(self, typ, value, tb):
+        # a response cut by an error is finished with the status already
+        # sent (200 once flushed), it must not be cached
+        self.cachebody = None
+        super().log_exception(typ, value, tb)
+
+    def on_finish(self):
+        super().on_finish()
+        metrics.RESULT_RECORDS.labels(self.endpoint).observe(self.records)
+        if self.cachebody is None or self.get_status() != 200:
+            return
+        headers = {}
+        if 'X-Next-Cursor' in self._headers:
+            headers['X-Next-Cursor'] = self._headers['X-Next-Cursor']
+        cache.set(self.request.uri, ''.join(self.cachebody).encode(), headers)
+
+    async def writeRecords(self, rrfound=None):
+        # waiting for the flush keeps the memory bounded with slow
+        # clients, False is returned when the client went away
+        rrfound = filterTimeWindow(rrfound, self.window)
+        if not rrfound:
+            return True
+        qof = JsonQOF(rrfound)
+        self.records += len(rrfound)
+        if self.cachebody is not None:
+            self.cachesize += len(qof)
+            if self.cachesize <= cache.max_entry:
+                self.cachebody.append(qof)
+            else:
+                self.cachebody = None
+        self.write(qof)
+        try:
+            await self.flush()
+        except tornado.iostream.StreamClosedError:
+            self.cachebody = None
+            return False
+        return True
+
+    async def writeAssociatedRecords(self, names=None):
+        async for rrfound in iterRecordsConcurrently(names=[x.strip() for x in names], types=self.types):
+            if not await self.writeRecords(rrfound):
+                return False
+        return True
+
+
+class QueryHandler(QOFHandler):
+    endpoint = 'query'
+
+    async def writeZone(self, zone=None, pagination=None):
+        # *.example.com, the records of all the names below the zone
+        if pagination is not None:
+            cursor, limit = pagination
+            names, cursor = await scanNames(zone=zone, cursor=cursor, limit=limit)
+            self.set_header('X-Next-Cursor', cursor)
+            await self.writeAssociatedRecords(names=names)
+            return
+        cursor = None
+        while cursor != '0':
+            names, cursor = await scanNames(zone=zone, cursor=cursor, limit=scan_count)
+            if not await self.writeAssociatedRecords(names=names):
+                return
+
+    async def writeNetwork(self, network=None, pagination=None):
+        # 192.0.2.0/24, the A or AAAA records pointing into the network
+        if self.types is not None and ('1' if network.version == 4 else '28') not in dict(self.types):
+            self.set_header('X-Next-Cursor', '0')
+            return
+        if pagination is not None:
+            cursor, limit = pagination
+            ips, cursor = await scanNetwork(network=network, cursor=cursor, limit=limit)
+            self.set_header('X-Next-Cursor', cursor)
+            async for rrfound in iterNetworkRecords(ips=ips):
+                if not await self.writeRecords(rrfound):
+                    return
+            return
+        cursor = None
+        while cursor != '0':
+            ips, cursor = await scanNetwork(network=network, cursor=cursor, limit=scan_count)
+            async for rrfound in iterNetworkRecords(ips=ips):
+                if not await self.writeRecords(rrfound):
+                    return
+
+    async def get(self, q):
         print(f'query: {q}')
+        pagination = getPagination(self)
+        try:
+            if q.startswith('*.'):
+                # without the index the zone would look empty
+                if 'names' not in indexes:
+                    raise tornado.web.HTTPError(501, reason='names index not enabled')
+                await self.writeZone(zone=q[2:], pagination=pagination)
+                return
+            if '/' in q:
+                if 'ips' not in indexes:
+                    raise tornado.web.HTTPError(501, reason='ips index not enabled')
+                await self.writeNetwork(network=parseNetwork(q), pagination=pagination)
+                return
+            if pagination is not None:
+                cursor, limit = pagination
+                if iptools.ipv4.validate_ip(q) or iptools.ipv6.validate_ip(q):
+                    names, cursor = await getAssociatedRecordsPage(rdata=q, cursor=cursor, limit=limit, types=self.types)
+                    self.set_header('X-Next-Cursor', cursor)
+                    await self.writeAssociatedRecords(names=names)
+                else:
+                    rrfound, cursor = await getRecordsPage(t=q.strip(), cursor=cursor, limit=limit, types=self.types)
+                    self.set_header('X-Next-Cursor', cursor)
+                    await self.writeRecords(rrfound)
+                return
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        # with a time window, the time index limits the tuples read
+        timed = self.window is not None and 'time' in indexes
         if iptools.ipv4.validate_ip(q) or iptools.ipv6.validate_ip(q):
-            for x in getAssociatedRecords(q):
-                self.write(JsonQOF(getRecord(x)))
+            if timed:
+                associated = iterAssociatedRecordsInWindow(rdata=q, window=self.window, types=self.types)
+            else:
+                associated = iterAssociatedRecords(rdata=q, types=self.types)
+            async for names in associated:
+                if not await self.writeAssociatedRecords(names=names):
+                    return
         else:
-            self.write(JsonQOF(getRecord(t=q.strip())))
+            if timed:
+                records = iterRecordsInWindow(names=[q.strip()], window=self.window, types=self.types)
+            else:
+                records = iterRecords(names=[q.strip()], types=self.types)
+            async for rrfound in records:
+                if not await self.writeRecords(rrfound):
+                    return
+
 
+class FullQueryHandler(QOFHandler):
+    endpoint = 'fquery'
 
-class FullQueryHandler(tornado.web.RequestHandler):
-    def get(self, q):
+    async def get(self, q):
         print(f'fquery: {q}')
-        if iptools.ipv4.validate_ip(q) or iptools.ipv6.validate_ip(q):
-            for x in getAssociatedRecords(q):
-                self.write(JsonQOF(getRecord(x)))
+        pagination = getPagination(self)
+        if pagination is not None:
+            cursor, limit = pagination
+            try:
+                names, cursor = await getAssociatedRecordsPage(
+                    rdata=q.strip(), cursor=cursor, limit=limit, types=self.types
+                )
+            except ValueError as e:
+                raise tornado.web.HTTPError(400, str(e))
+            self.set_header('X-Next-Cursor', cursor)
+            await self.writeAssociatedRecords(names=names)
+            return
+        if self.window is not None and 'time' in indexes:
+            associated = iterAssociatedRecordsInWindow(rdata=q, window=self.window, types=self.types)
         else:
-            for x in getAssociatedRecords(q):
-                self.write(JsonQOF(getRecord(t=x.strip())))
+            associated = iterAssociatedRecords(rdata=q, types=self.types)
+        async for names in associated:
+            if not await self.writeAssociatedRecords(names=names):
+                return
+
+
+def getBatch(handler=None):
+    # a JSON array of names and IP addresses, or an object with a queries
+    # array, deduplicated in their order
+    try:
+        body = json.loads(handler.request.body)
+    except ValueError:
+        raise tornado.web.HTTPError(400, 'invalid JSON body')
+    if isinstance(body, dict):
+        body = body.get('queries')
+    if not isinstance(body, list) or not all(isinstance(q, str) for q in body):
+        raise tornado.web.HTTPError(400, 'a list of queries is expected')
+    queries = list(dict.fromkeys(q.strip() for q in body if q.strip()))
+    if len(queries) > batch_max:
+        raise tornado.web.HTTPError(413, f'more than {batch_max} queries')
+    for q in queries:
+        if q.startswith('*.') or '/' in q:
+            raise tornado.web.HTTPError(400, f'unsupported query {q} in a batch')
+    return queries
+
+
+class BatchQueryHandler(QOFHandler):
+    # POST /query/batch, the records of many names and IP addresses in a
+    # single response, each one tagged with the query it answers
+    endpoint = 'batch'
+
+    async def post(self):
+        queries = getBatch(self)
+        print(f'batch: {len(queries)} queries')
+        ips = {q: None for q in queries if iptools.ipv4.validate_ip(q) or iptools.ipv6.validate_ip(q)}
+        # name -> queries answered by its records, the names queried and
+        # the ones associated to the IP addresses are resolved together
+        wanted = {q: [q] for q in queries if q not in ips}
+        if ips:
+            for ip, names in (await getAssociatedNames(ips=list(ips), types=self.types)).items():
+                for name in names:
+                    wanted.setdefault(name, []).append(ip)
+        names = list(wanted)
+        for i in range(0, len(names), scan_count):
+            async for rrfound in iterRecordsConcurrently(names=names[i:i + scan_count], types=self.types):
+                tagged = [dict(rr, query=q) for rr in rrfound for q in wanted[rr['rrname']]]
+                if not await self.writeRecords(tagged):
+                    return
+
+
+class CacheHandler(TimedHandler):
+    endpoint = 'cache'
+
+    def get(self):
+        self.write(cache.stats())
+
+    def delete(self):
+        cache.clear()
+        self.write(cache.stats())
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        if not metrics.enabled:
+            raise tornado.web.HTTPError(501, 'prometheus_client is not installed')
+        content_type, body = metrics.exposition()
+        self.set_header('Content-Type', content_type)
+        self.write(body)
 
 
 application = tornado.web.Application(
     [
+        (r"/query/batch", BatchQueryHandler),
         (r"/query/(.*)", QueryHandler),
         (r"/fquery/(.*)", FullQueryHandler),
         (r"/info", InfoHandler),
+        (r"/cache", CacheHandler),
+        (r"/metrics", MetricsHandler),
     ]
 )
 
 if __name__ == "test":
 
-    qq = ["foo.be", "8.8.8.8"]
+    async def test():
+        qq = ["foo.be", "8.8.8.8"]
 
-    for q in qq:
-        if iptools.ipv4.validate_ip(q) or iptools.ipv6.validate_ip(q):
-            for x in getAssociatedRecords(q):
-                print(JsonQOF(getRecord(x)))
-        else:
-            print(JsonQOF(getRecord(t=q)))
+        for q in qq:
+            if iptools.ipv4.validate_ip(q) or iptools.ipv6.validate_ip(q):
+                for x in await getAssociatedRecords(q):
+                    print(JsonQOF(await getRecord(x)))
+            else:
+                print(JsonQOF(await getRecord(t=q)))
+
+    asyncio.run(test())
 else:
     application.listen(8400)
     tornado.ioloop.IOLoop.instance().start()
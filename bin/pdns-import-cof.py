@@ -13,28 +13,51 @@
 
 import redis
 import json
+import configparser
 import logging
 import sys
 import argparse
 import os
-import ndjson
+import signal
+import time
+import asyncio
+import multiprocessing as mp
+from collections import Counter, deque
 
-# ! websocket-client not websocket
-import websocket
+from lib.cof import iter_blocks, open_dump, read_range, split_ranges, valid_record
+from lib.exclude import Exclusion
+from lib import metrics
+from lib.stats import StatsCollector
+from lib.storage import Storage, enabled_indexes, ignored_indexes_warning, retention_bucket
+
+from tornado.websocket import websocket_connect
 
 parser = argparse.ArgumentParser(
     description='Import array of standard Passive DNS cof format into your Passive DNS server'
 )
-parser.add_argument('--file', dest='filetoimport', help='JSON file to import')
+parser.add_argument('--file', dest='filetoimport', help='NDJSON file to import (.gz and .zst are decompressed)')
+parser.add_argument('--workers', dest='workers', type=int, default=os.cpu_count(), help='Number of processes loading the file')
+parser.add_argument('--batch', dest='batch', type=int, default=1000, help='Number of records written per pipeline')
+parser.add_argument(
+    '--websocket', dest='websocket', nargs='+', help='Import from one or more websocket streams'
+)
+parser.add_argument(
+    '--queue-size', dest='queuesize', type=int, default=10000, help='Maximum number of received messages waiting to be written'
+)
 parser.add_argument(
-    '--websocket', dest='websocket', help='Import from a websocket stream'
+    '--flush-interval', dest='flushinterval', type=float, default=1, help='Maximum seconds between two writes of the websocket records'
+)
+parser.add_argument(
+    '--metrics-port', dest='metricsport', type=int, default=0, help='Port of the /metrics endpoint (disabled by default)'
+)
+parser.add_argument(
+    '--stats-interval', dest='statsinterval', type=int, default=60, help='Seconds between two logs of the websocket counters'
 )
 args = parser.parse_args()
 
 
 logger = logging.getLogger('pdns ingestor')
 ch = logging.StreamHandler()
-logger.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 ch.setFormatter(formatter)
 logger.addHandler(ch)
@@ -43,16 +66,30 @@ logger.info("Starting COF ingestor")
 
 analyzer_redis_host = os.getenv('D4_ANALYZER_REDIS_HOST', '127.0.0.1')
 analyzer_redis_port = int(os.getenv('D4_ANALYZER_REDIS_PORT', 6400))
+analyzer_redis_db = int(os.getenv('D4_ANALYZER_REDIS_DB', 0))
 
-r = redis.Redis(host='127.0.0.1', port=6400)
+r = redis.Redis(host=analyzer_redis_host, port=analyzer_redis_port, db=analyzer_redis_db)
+config = configparser.RawConfigParser()
+config.read('../etc/analyzer.conf')
+store = Storage(
+    r, layout=config.get('storage', 'layout', fallback='keys'), bucket=retention_bucket(config), indexes=enabled_indexes(config)
+)
+if ignored_indexes_warning(config):
+    logger.warning(ignored_indexes_warning(config))
+logger.setLevel(config.get('global', 'logging-level', fallback='INFO'))
 
-excludesubstrings = ['spamhaus.org', 'asn.cymru.com']
+excludesubstrings = config.get('exclude', 'substring', fallback='spamhaus.org,asn.cymru.com').split(',')
+exclusion = Exclusion(substrings=excludesubstrings, path=config.get('exclude', 'file', fallback=None))
 with open('../etc/records-type.json') as rtypefile:
     rtype = json.load(rtypefile)
 
 dnstype = {}
 
 stats = True
+stats_flush_interval = config.getfloat('stats', 'flush-interval', fallback=5)
+stats_bucket = config.getint('stats', 'bucket', fallback=0)
+# statistics of the websocket streams, the bulk load workers have their own
+collector = StatsCollector(r, interval=stats_flush_interval, bucket=stats_bucket)
 
 for v in rtype:
     dnstype[(v['type'])] = v['value']
@@ -63,80 +100,240 @@ if (not (args.filetoimport)) and (not (args.websocket)):
     sys.exit(0)
 
 
-def add_record(rdns=None):
+def prepare_record(rdns=None):
     if rdns is None:
-        return False
+        return None
     logger.debug("parsed record: {}".format(rdns))
-    if 'rrname' not in rdns:
-        logger.debug(
-            'Parsing of passive DNS line is incomplete: {}'.format(rdns.strip())
+    if not valid_record(rdns):
+        logger.debug('Passive DNS record is incomplete or invalid: {}'.format(rdns))
+        return None
+    rdns['type'] = dnstype.get(rdns['rrtype'])
+    if rdns['type'] is None:
+        logger.debug('Unknown type {} for {}'.format(rdns['rrtype'], rdns['rrname']))
+        return None
+    rdns['v'] = rdns['rdata']
+    if exclusion.match(rdns['rrname'].lower()) is not None:
+        logger.debug('Excluded {}'.format(rdns['rrname']))
+        return None
+    if rdns['type'] == '16':
+        rdns['v'] = rdns['v'].replace("\"", "", 1)
+    return rdns
+
+
+def write_records(records=None, pipe=None, collector=None):
+    sensors = Counter()
+    for rdns in records:
+        logger.debug('redis upsert: {} {} {}'.format(rdns['rrname'], rdns['v'], rdns['type']))
+        store.upsert(
+            rdns['rrname'],
+            rdns['v'],
+            rdns['type'],
+            first=float(rdns['time_first']),
+            last=float(rdns['time_last']),
+            count=rdns.get('count', 1),
+            setcount='count' in rdns,
+            pipe=pipe,
         )
-        return False
-    if rdns['rrname'] and rdns['rrtype']:
-        rdns['type'] = dnstype[rdns['rrtype']]
-        rdns['v'] = rdns['rdata']
-        excludeflag = False
-        for exclude in excludesubstrings:
-            if exclude in rdns['rrname']:
-                excludeflag = True
-        if excludeflag:
-            logger.debug('Excluded {}'.format(rdns['rrname']))
-            return False
-        if rdns['type'] == '16':
-            rdns['v'] = rdns['v'].replace("\"", "", 1)
-        query = "r:{}:{}".format(rdns['rrname'], rdns['type'])
-        logger.debug('redis sadd: {} -> {}'.format(query, rdns['v']))
-        r.sadd(query, rdns['v'])
-        res = "v:{}:{}".format(rdns['v'], rdns['type'])
-        logger.debug('redis sadd: {} -> {}'.format(res, rdns['rrname']))
-        r.sadd(res, rdns['rrname'])
-
-        firstseen = "s:{}:{}:{}".format(rdns['rrname'], rdns['v'], rdns['type'])
-        if not r.exists(firstseen):
-            r.set(firstseen, int(float(rdns['time_first'])))
-            logger.debug('redis set: {} -> {}'.format(firstseen, rdns['time_first']))
-
-        lastseen = "l:{}:{}:{}".format(rdns['rrname'], rdns['v'], rdns['type'])
-        last = r.get(lastseen)
-        if last is None or int(float(last)) < int(float(rdns['time_last'])):
-            r.set(lastseen, int(float(rdns['time_last'])))
-            logger.debug('redis set: {} -> {}'.format(lastseen, rdns['time_last']))
-
-        occ = "o:{}:{}:{}".format(rdns['rrname'], rdns['v'], rdns['type'])
-        if 'count' in rdns:
-            r.set(occ, rdns['count'])
-        else:
-            r.incrby(occ, amount=1)
-
-        if stats:
-            r.incrby('stats:processed', amount=1)
-            r.sadd('sensors:seen', rdns["sensor_id"])
-            r.zincrby('stats:sensors', 1, rdns["sensor_id"])
-    if not r:
-        logger.info('empty passive dns record')
-        return False
-
-
-def on_open(ws):
-    logger.debug('[websocket] connection open')
-
-
-def on_close(ws):
-    logger.debug('[websocket] connection closed')
-
-
-def on_message(ws, message):
-    logger.debug('Message received via websocket')
-    add_record(rdns=json.loads(message))
+        if rdns.get('sensor_id') is not None:
+            sensors[rdns['sensor_id']] += 1
+    if stats and records:
+        collector.add(len(records), sensors)
+    if collector.due():
+        collector.flush(pipe)
+
+
+def load(task=None):
+    # a task is either a byte range of an uncompressed file or a block of
+    # lines read from a compressed one
+    lines = read_range(*task) if isinstance(task, tuple) else task.splitlines()
+    pipe = r.pipeline(transaction=False)
+    collector = StatsCollector(r, interval=stats_flush_interval, bucket=stats_bucket)
+    records = []
+    imported = skipped = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            rdns = prepare_record(json.loads(line))
+        except (ValueError, AttributeError):
+            rdns = None
+        if rdns is None:
+            skipped += 1
+            continue
+        records.append(rdns)
+        if len(records) >= args.batch:
+            write_records(records, pipe, collector)
+            pipe.execute()
+            imported += len(records)
+            records = []
+    write_records(records, pipe, collector)
+    collector.flush(pipe)
+    pipe.execute()
+    imported += len(records)
+    return imported, skipped
+
+
+def bulk_load(path=None):
+    if path.endswith(('.gz', '.zst')):
+        # compressed streams cannot be split, they are read here and the
+        # blocks of lines dispatched to the workers
+        dump = open_dump(path)
+        tasks = iter_blocks(dump)
+    else:
+        dump = None
+        tasks = ((path, start, end) for start, end in split_ranges(path))
+    start = time.time()
+    imported = skipped = 0
+    ctx = mp.get_context('fork')
+    with ctx.Pool(max(args.workers, 1), initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN)) as pool:
+        # a bounded number of tasks in flight keeps the memory constant
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(load, (task,)))
+            if len(pending) >= args.workers * 2:
+                done, failed = pending.popleft().get()
+                imported += done
+                skipped += failed
+                metrics.RECORDS.labels('import-cof').inc(done)
+                metrics.SKIPPED.labels('import-cof').inc(failed)
+                logger.info('{} records imported ({:.0f} records/s)'.format(imported, imported / (time.time() - start)))
+        while pending:
+            done, failed = pending.popleft().get()
+            imported += done
+            skipped += failed
+            metrics.RECORDS.labels('import-cof').inc(done)
+            metrics.SKIPPED.labels('import-cof').inc(failed)
+    if dump is not None:
+        dump.close()
+    elapsed = time.time() - start
+    logger.info(
+        'Import done, {} records imported and {} skipped in {:.0f}s ({:.0f} records/s)'.format(
+            imported, skipped, elapsed, imported / elapsed if elapsed else 0
+        )
+    )
+
+
+def reload_exclusion(signum, frame):
+    try:
+        rules = exclusion.reload()
+    except OSError as e:
+        logger.error('Reload of the exclusion rules failed: {}'.format(e))
+        return
+    logger.info(
+        'Reloaded {} exclusion rules, hits so far: {}'.format(
+            rules, dict(exclusion.hits.most_common())
+        )
+    )
+
+
+signal.signal(signal.SIGHUP, reload_exclusion)
+
+
+# counters of the websocket feeds, per url
+received = Counter()
+dropped = Counter()
+reconnects = Counter()
+written = 0
+
+
+async def consume(url=None, queue=None):
+    backoff = 1
+    while True:
+        try:
+            conn = await websocket_connect(url)
+        except Exception as e:
+            logger.warning('[websocket] connection to {} failed: {}, retrying in {}s'.format(url, e, backoff))
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+            continue
+        logger.info('[websocket] connection to {} open'.format(url))
+        backoff = 1
+        while True:
+            message = await conn.read_message()
+            if message is None:
+                break
+            received[url] += 1
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # the writes are behind, the feed is not slowed down
+                dropped[url] += 1
+        reconnects[url] += 1
+        logger.warning('[websocket] connection to {} closed, reconnecting'.format(url))
+        await asyncio.sleep(backoff)
+
+
+def write_messages(messages=None):
+    start = time.perf_counter()
+    records = []
+    for message in messages:
+        try:
+            rdns = prepare_record(json.loads(message))
+        except (ValueError, AttributeError):
+            rdns = None
+        if rdns is not None:
+            records.append(rdns)
+    pipe = r.pipeline(transaction=False)
+    write_records(records, pipe, collector)
+    metrics.execute(pipe, 'upsert')
+    metrics.STAGE_SECONDS.labels('write').observe(time.perf_counter() - start)
+    metrics.RECORDS.labels('websocket').inc(len(records))
+    metrics.SKIPPED.labels('websocket').inc(len(messages) - len(records))
+    return len(records)
+
+
+async def write(queue=None):
+    global written
+    loop = asyncio.get_running_loop()
+    while True:
+        messages = [await queue.get()]
+        deadline = loop.time() + args.flushinterval
+        while len(messages) < args.batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                messages.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # the redis client is synchronous, the receiving goes on meanwhile
+        try:
+            written += await loop.run_in_executor(None, write_messages, messages)
+        except redis.RedisError as e:
+            logger.error('Write of {} records failed: {}'.format(len(messages), e))
+        except Exception:
+            # the writer must outlive any record it is given
+            logger.exception('Write of {} records failed'.format(len(messages)))
+
+
+async def report(queue=None):
+    while True:
+        await asyncio.sleep(args.statsinterval)
+        for url in args.websocket:
+            logger.info(
+                '[websocket] {}: {} received, {} dropped, {} reconnects'.format(
+                    url, received[url], dropped[url], reconnects[url]
+                )
+            )
+        logger.info('[websocket] {} records written, {} messages queued'.format(written, queue.qsize()))
+
+
+async def stream(urls=None):
+    queue = asyncio.Queue(maxsize=args.queuesize)
+    metrics.QUEUE_DEPTH.labels('websocket').set_function(queue.qsize)
+    metrics.register_counter('pdns_websocket_messages_total', 'Messages received from each stream', 'feed', lambda: received)
+    metrics.register_counter('pdns_websocket_dropped_total', 'Messages dropped because the queue was full', 'feed', lambda: dropped)
+    metrics.register_counter('pdns_websocket_reconnects_total', 'Reconnections to each stream', 'feed', lambda: reconnects)
+    metrics.register_counter('pdns_exclusion_hits_total', 'Records excluded by each rule', 'rule', lambda: exclusion.hits)
+    metrics.start_server(args.metricsport)
+    await asyncio.gather(write(queue), report(queue), *[consume(url, queue) for url in urls])
 
 
 if args.filetoimport:
-    with open(args.filetoimport, "r") as dnsimport:
-        reader = ndjson.load(dnsimport)
-        for rdns in reader:
-            add_record(rdns=rdns)
+    metrics.start_server(args.metricsport)
+    bulk_load(args.filetoimport)
 elif args.websocket:
-    ws = websocket.WebSocketApp(
-        args.websocket, on_open=on_open, on_close=on_close, on_message=on_message
-    )
-    ws.run_forever()
+    try:
+        asyncio.run(stream(args.websocket))
+    finally:
+        collector.flush()
@@ -13,7 +13,6 @@
 
 import re
 import redis
-import fileinput
 import json
 import configparser
 import time
@@ -22,8 +21,19 @@ import sys
 import argparse
 import os
 
+from lib.cof import iter_json_array, valid_record
+from lib.exclude import Exclusion
+from lib import metrics
+from lib.stats import StatsCollector
+from lib.storage import Storage, enabled_indexes, ignored_indexes_warning, retention_bucket
+
 parser = argparse.ArgumentParser(description='Import array of standard Passive DNS cof format into your Passive DNS server')
 parser.add_argument('--file', dest='filetoimport', help='JSON file to import')
+parser.add_argument('--batch', dest='batch', type=int, default=1000, help='Number of records written per pipeline')
+parser.add_argument('--checkpoint', dest='checkpoint', help='Checkpoint file (default: <file>.checkpoint)')
+parser.add_argument('--resume', dest='resume', action='store_true', help='Resume the import from the checkpoint')
+parser.add_argument('--metrics-port', dest='metricsport', type=int, default=0, help='Port of the /metrics endpoint (disabled by default)')
+parser.add_argument('--progress-interval', dest='progress', type=int, default=10, help='Seconds between two progress reports')
 args = parser.parse_args()
 
 config = configparser.RawConfigParser()
@@ -31,6 +41,7 @@ config.read('../etc/analyzer.conf')
 
 expirations = config.items('expiration')
 excludesubstrings = config.get('exclude', 'substring').split(',')
+excludefile = config.get('exclude', 'file', fallback=None)
 myuuid = config.get('global', 'my-uuid')
 myqueue = "analyzer:8:{}".format(myuuid)
 mylogginglevel = config.get('global', 'logging-level')
@@ -50,13 +61,20 @@ logger.info("Starting and using FIFO {} from D4 server".format(myqueue))
 
 analyzer_redis_host = os.getenv('D4_ANALYZER_REDIS_HOST', '127.0.0.1')
 analyzer_redis_port = int(os.getenv('D4_ANALYZER_REDIS_PORT', 6400))
+analyzer_redis_db = int(os.getenv('D4_ANALYZER_REDIS_DB', 0))
 
 d4_server, d4_port = config.get('global', 'd4-server').split(':')
 host_redis_metadata = os.getenv('D4_REDIS_METADATA_HOST', d4_server)
 port_redis_metadata = int(os.getenv('D4_REDIS_METADATA_PORT', d4_port))
 
-r = redis.Redis(host=analyzer_redis_host, port=analyzer_redis_port)
+r = redis.Redis(host=analyzer_redis_host, port=analyzer_redis_port, db=analyzer_redis_db)
 r_d4 = redis.Redis(host=host_redis_metadata, port=port_redis_metadata, db=2)
+store = Storage(
+    r, layout=config.get('storage', 'layout', fallback='keys'), bucket=retention_bucket(config), indexes=enabled_indexes(config)
+)
+if ignored_indexes_warning(config):
+    logger.warning(ignored_indexes_warning(config))
+exclusion = Exclusion(substrings=excludesubstrings, path=excludefile)
 
 with open('../etc/records-type.json') as rtypefile:
     rtype = json.load(rtypefile)
@@ -64,60 +82,95 @@ with open('../etc/records-type.json') as rtypefile:
 dnstype = {}
 
 stats = True
+collector = StatsCollector(
+    r, interval=config.getfloat('stats', 'flush-interval', fallback=5), bucket=config.getint('stats', 'bucket', fallback=0)
+)
 
 for v in rtype:
     dnstype[(v['type'])] = v['value']
 
-expiration = None
 if not (args.filetoimport):
     parser.print_help()
     sys.exit(0)
-with open(args.filetoimport) as dnsimport:
-    records = json.load(dnsimport)
-
-print (records)
-for rdns in records:
-    logger.debug("parsed record: {}".format(r))
-    if 'rrname' not in rdns:
-        logger.debug('Parsing of passive DNS line is incomplete: {}'.format(l.strip()))
-        continue
-    if rdns['rrname'] and rdns['rrtype']:
-        rdns['type'] = dnstype[rdns['rrtype']]
+
+checkpoint = args.checkpoint or '{}.checkpoint'.format(args.filetoimport)
+
+
+def flush(batch=None, offset=None):
+    # the offset of the last record of a batch is only saved once the batch
+    # is written, a resumed import can only write some records twice
+    pipe = r.pipeline(transaction=False)
+    for rdns in batch:
+        store.upsert(
+            rdns['rrname'],
+            rdns['v'],
+            rdns['type'],
+            first=rdns['time_first'],
+            last=rdns['time_last'],
+            count=rdns.get('count', 1),
+            setcount='count' in rdns,
+            pipe=pipe,
+        )
+    if stats and batch:
+        collector.add(len(batch))
+    if collector.due():
+        collector.flush(pipe)
+    metrics.execute(pipe, 'upsert')
+    metrics.RECORDS.labels('import').inc(len(batch))
+    with open(checkpoint, 'w') as f:
+        f.write(str(offset))
+
+
+offset = 0
+if args.resume and os.path.exists(checkpoint):
+    with open(checkpoint) as f:
+        offset = int(f.read().strip() or 0)
+    logger.info('Resuming the import of {} at offset {}'.format(args.filetoimport, offset))
+
+metrics.register_counter('pdns_exclusion_hits_total', 'Records excluded by each rule', 'rule', lambda: exclusion.hits)
+metrics.start_server(args.metricsport)
+
+size = os.path.getsize(args.filetoimport)
+start = last_report = time.time()
+imported = skipped = 0
+batch = []
+with open(args.filetoimport, 'rb') as dnsimport:
+    for rdns, position in iter_json_array(dnsimport, offset=offset):
+        offset = position
+        logger.debug("parsed record: {}".format(rdns))
+        if not valid_record(rdns):
+            logger.debug('Passive DNS record is incomplete or invalid: {}'.format(rdns))
+            skipped += 1
+            metrics.SKIPPED.labels('import').inc()
+            continue
+        rdns['type'] = dnstype.get(rdns['rrtype'])
+        if rdns['type'] is None:
+            logger.debug('Unknown type {} for {}'.format(rdns['rrtype'], rdns['rrname']))
+            skipped += 1
+            metrics.SKIPPED.labels('import').inc()
+            continue
         rdns['v'] = rdns['rdata']
-        excludeflag = False
-        for exclude in excludesubstrings:
-            if exclude in rdns['rrname']:
-               excludeflag = True
-        if excludeflag:
+        if exclusion.match(rdns['rrname'].lower()) is not None:
             logger.debug('Excluded {}'.format(rdns['rrname']))
+            skipped += 1
+            metrics.SKIPPED.labels('import').inc()
             continue
         if rdns['type'] == '16':
             rdns['v'] = rdns['v'].replace("\"", "", 1)
-        query = "r:{}:{}".format(rdns['rrname'],rdns['type'])
-        logger.debug('redis sadd: {} -> {}'.format(query,rdns['v']))
-        r.sadd(query, rdns['v'])
-        res = "v:{}:{}".format(rdns['v'], rdns['type'])
-        logger.debug('redis sadd: {} -> {}'.format(res,rdns['rrname']))
-        r.sadd(res, rdns['rrname'])
-
-        firstseen = "s:{}:{}:{}".format(rdns['rrname'], rdns['v'], rdns['type'])
-        if not r.exists(firstseen):
-            r.set(firstseen, rdns['time_first'])
-            logger.debug('redis set: {} -> {}'.format(firstseen, rdns['time_first']))
-
-
-        lastseen = "l:{}:{}:{}".format(rdns['rrname'], rdns['v'], rdns['type'])
-        last = r.get(lastseen)
-        if last is None or int(last) < int(rdns['time_last']):
-            r.set(lastseen, rdns['time_last'])
-            logger.debug('redis set: {} -> {}'.format(lastseen, rdns['time_last']))
-
-        occ = "o:{}:{}:{}".format(rdns['rrname'], rdns['v'], rdns['type'])
-        r.set(occ, rdns['count'])
-
-
-        if stats:
-            r.incrby('stats:processed', amount=1)
-    if not r:
-        logger.info('empty passive dns record')
-        continue
+        batch.append(rdns)
+        if len(batch) >= args.batch:
+            flush(batch, offset)
+            imported += len(batch)
+            batch = []
+            if time.time() - last_report >= args.progress:
+                last_report = time.time()
+                logger.info(
+                    '{} records imported, {} skipped ({:.0f} records/s, {:.1f}% of the file)'.format(
+                        imported, skipped, imported / (last_report - start), offset * 100 / size if size else 100
+                    )
+                )
+    flush(batch, offset)
+    imported += len(batch)
+collector.flush()
+
+logger.info('Import done, {} records imported and {} skipped in {:.0f}s'.format(imported, skipped, time.time() - start))
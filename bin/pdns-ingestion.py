@@ -23,15 +23,46 @@ import time
 import logging
 import sys
 import os
+import argparse
+import multiprocessing
+import queue
+import signal
+import threading
+import zlib
+from collections import Counter
+
+from lib.aggregate import Aggregator
+from lib.d4queue import D4Queue
+from lib.exclude import Exclusion
+from lib import metrics
+from lib.parser import parse_passivedns
+from lib.stats import StatsCollector
+from lib.storage import Storage, enabled_indexes, ignored_indexes_warning, retention_bucket
+
+parser = argparse.ArgumentParser(description='D4 analyzer ingesting passivedns records into the Passive DNS backend')
+parser.add_argument('--workers', dest='workers', type=int, default=None, help='Number of ingestion worker processes (default from analyzer.conf)')
+parser.add_argument('--metrics-port', dest='metricsport', type=int, default=None, help='Port of the /metrics endpoint (default from analyzer.conf)')
+args = parser.parse_args()
 
 config = configparser.RawConfigParser()
 config.read('../etc/analyzer.conf')
 
-expirations = config.items('expiration')
+expirations = dict(config.items('expiration'))
 excludesubstrings = config.get('exclude', 'substring').split(',')
-myuuid = config.get('global', 'my-uuid')
-myqueue = "analyzer:8:{}".format(myuuid)
+excludefile = config.get('exclude', 'file', fallback=None)
+# one or more D4 analyzer queues separated by a comma
+myuuids = [uuid.strip() for uuid in config.get('global', 'my-uuid').split(',')]
+myqueues = ["analyzer:8:{}".format(myuuid) for myuuid in myuuids]
 mylogginglevel = config.get('global', 'logging-level')
+batch_size = config.getint('ingestion', 'batch-size', fallback=500)
+flush_interval = config.getfloat('ingestion', 'flush-interval', fallback=1)
+queue_min_batch = config.getint('ingestion', 'queue-min-batch', fallback=16)
+queue_max_batch = config.getint('ingestion', 'queue-max-batch', fallback=1000)
+workers = args.workers or config.getint('ingestion', 'workers', fallback=1)
+stats_interval = config.getint('ingestion', 'stats-interval', fallback=60)
+stats_flush_interval = config.getfloat('stats', 'flush-interval', fallback=5)
+stats_bucket = config.getint('stats', 'bucket', fallback=0)
+metrics_port = args.metricsport if args.metricsport is not None else config.getint('metrics', 'port', fallback=0)
 logger = logging.getLogger('pdns ingestor')
 ch = logging.StreamHandler()
 if mylogginglevel == 'DEBUG':
@@ -44,17 +75,23 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
-logger.info("Starting and using FIFO {} from D4 server".format(myqueue))
+logger.info("Starting and using FIFO {} from D4 server".format(', '.join(myqueues)))
 
 analyzer_redis_host = os.getenv('D4_ANALYZER_REDIS_HOST', '127.0.0.1')
 analyzer_redis_port = int(os.getenv('D4_ANALYZER_REDIS_PORT', 6400))
+analyzer_redis_db = int(os.getenv('D4_ANALYZER_REDIS_DB', 0))
 
 d4_server, d4_port = config.get('global', 'd4-server').split(':')
 host_redis_metadata = os.getenv('D4_REDIS_METADATA_HOST', d4_server)
 port_redis_metadata = int(os.getenv('D4_REDIS_METADATA_PORT', d4_port))
 
-r = redis.Redis(host=analyzer_redis_host, port=analyzer_redis_port)
+r = redis.Redis(host=analyzer_redis_host, port=analyzer_redis_port, db=analyzer_redis_db)
 r_d4 = redis.Redis(host=host_redis_metadata, port=port_redis_metadata, db=2)
+store = Storage(
+    r, layout=config.get('storage', 'layout', fallback='keys'), bucket=retention_bucket(config), indexes=enabled_indexes(config)
+)
+if ignored_indexes_warning(config):
+    logger.warning(ignored_indexes_warning(config))
 
 
 with open('../etc/records-type.json') as rtypefile:
@@ -67,108 +104,262 @@ stats = True
 for v in rtype:
     dnstype[(v['type'])] = v['value']
 
+# malformed lines by reason
+parse_errors = Counter()
 
-def process_format_passivedns(line=None):
-    # log line example
-    # timestamp||ip-src||ip-dst||class||q||type||v||ttl||count
-    # 1548624738.280922||192.168.1.12||8.8.8.8||IN||www-google-analytics.l.google.com.||AAAA||2a00:1450:400e:801::200e||299||12
-    vkey = ['timestamp','ip-src','ip-dst','class','q','type','v','ttl','count']
-    record = {}
-    if line is None or line == '':
-        return False
-    v = line.split("||")
-    i = 0
-    for r in v:
-        # trailing dot is removed and avoid case sensitivity
-        if i == 4 or i == 6:
-            r = r.lower().strip('.')
-        # timestamp is just epoch - second precision is only required
-        if i == 0:
-            r = r.split('.')[0]
-        record[vkey[i]] = r
-        # replace DNS type with the known DNS record type value
-        if i == 5:
-            record[vkey[i]] = dnstype[r]
-        i = i + 1
-    return record
-
-
-while (True):
-    expiration = None
-    d4_record_line = r_d4.rpop(myqueue)
-    if d4_record_line is None:
-        time.sleep (1)
-        continue
-    l = d4_record_line.decode('utf-8')
-    rdns = process_format_passivedns(line=l.strip())
-    logger.debug("parsed record: {}".format(rdns))
-    if rdns is False:
-        logger.debug('Parsing of passive DNS line failed: {}'.format(l.strip()))
-        continue
-    if 'q' not in rdns:
-        logger.debug('Parsing of passive DNS line is incomplete: {}'.format(l.strip()))
-        continue
-    if rdns['q'] and rdns['type']:
-        excludeflag = False
-        for exclude in excludesubstrings:
-            if exclude in rdns['q']:
-               excludeflag = True
-        if excludeflag:
-            logger.debug('Excluded {}'.format(rdns['q']))
+exclusion = Exclusion(substrings=excludesubstrings, path=excludefile)
+
+metrics.register_counter('pdns_parse_errors_total', 'Malformed passive DNS lines', 'reason', lambda: parse_errors)
+metrics.register_counter('pdns_exclusion_hits_total', 'Records excluded by each rule', 'rule', lambda: exclusion.hits)
+
+
+def flush_records(batch=None, collector=None):
+    aggregated, records = batch.drain()
+    if not aggregated:
+        return 0
+    start = time.perf_counter()
+    pipe = r.pipeline(transaction=False)
+    for rrname, rdata, rrtype, first, last, count in aggregated:
+        logger.debug('redis upsert: {} {} {}'.format(rrname, rdata, rrtype))
+        store.upsert(
+            rrname,
+            rdata,
+            rrtype,
+            first=first,
+            last=last,
+            count=count,
+            # the retention index replaces the expiration of the records
+            expiration=None if store.bucket else expirations.get(rrtype),
+            pipe=pipe,
+        )
+
+    if stats:
+        collector.add(records)
+    # the statistics ride along with the records when they are due
+    if collector.due():
+        collector.flush(pipe)
+    metrics.execute(pipe, 'upsert')
+    metrics.STAGE_SECONDS.labels('write').observe(time.perf_counter() - start)
+    metrics.RECORDS.labels('ingestion').inc(records)
+    logger.debug('Flushed {} records ({} distinct)'.format(records, len(aggregated)))
+    return records
+
+
+def prepare_records(lines=None):
+    start = time.perf_counter()
+    records, errors = parse_passivedns(lines=lines, dnstype=dnstype)
+    if errors:
+        parse_errors.update(errors)
+        logger.debug('Parsing of {} passive DNS lines failed: {}'.format(sum(errors.values()), dict(errors)))
+    prepared = []
+    match = exclusion.match
+    for rdns in records:
+        if match(rdns[2]) is not None:
+            logger.debug('Excluded {}'.format(rdns[2]))
+            continue
+        prepared.append(rdns)
+    metrics.STAGE_SECONDS.labels('parse').observe(time.perf_counter() - start)
+    return prepared
+
+
+def ingest(pop=None, processed=None):
+    # pop() returns a list of lines, an empty list when nothing was
+    # available for a second and None when the ingestion must stop
+    batch = Aggregator(max_entries=batch_size, window=flush_interval)
+    # TTL, Class, DNS Type distribution stats
+    collector = StatsCollector(r, interval=stats_flush_interval, bucket=stats_bucket)
+    dist = collector.dist
+    while (True):
+        d4_record_lines = pop()
+        if d4_record_lines is None:
+            done = flush_records(batch, collector)
+            collector.flush()
+            if processed is not None:
+                with processed.get_lock():
+                    processed.value += done
+            if parse_errors:
+                logger.info('Malformed passive DNS lines: {}'.format(dict(parse_errors)))
+            if exclusion.hits:
+                logger.info('Exclusion hits: {}'.format(dict(exclusion.hits.most_common())))
+            return
+        for timestamp, rrclass, rrname, rrtype, rdata, ttl in prepare_records(lines=d4_record_lines):
+            batch.add(rrname, rdata, rrtype, int(timestamp))
+            dist['dist:ttl'][ttl] += 1
+            dist['dist:class'][rrclass] += 1
+            dist['dist:type'][rrtype] += 1
+        # identical records are coalesced until the batch is full or
+        # the oldest record waited for flush-interval
+        if batch.due():
+            done = flush_records(batch, collector)
+            if processed is not None:
+                with processed.get_lock():
+                    processed.value += done
+        elif collector.due():
+            collector.flush()
+
+
+def shard(line=None, shards=1):
+    # all the records of a rrname are handled by the same worker
+    fields = line.split(b'||', 5)
+    if len(fields) < 5:
+        return 0
+    return zlib.crc32(fields[4].strip().lower().rstrip(b'.')) % shards
+
+
+def read_queue(d4queue=None, worker_queues=None, stop=None):
+    while not stop.is_set():
+        lines = d4queue.pop()
+        if not lines:
             continue
-        for y in expirations:
-            if y[0] == rdns['type']:
-                expiration=y[1]
-        if rdns['type'] == '16':
-            rdns['v'] = rdns['v'].replace("\"", "", 1)
-        query = "r:{}:{}".format(rdns['q'],rdns['type'])
-        logger.debug('redis sadd: {} -> {}'.format(query,rdns['v']))
-        r.sadd(query, rdns['v'])
-        if expiration:
-            logger.debug("Expiration {} {}".format(expiration, query))
-            r.expire(query, expiration)
-        res = "v:{}:{}".format(rdns['v'], rdns['type'])
-        logger.debug('redis sadd: {} -> {}'.format(res,rdns['q']))
-        r.sadd(res, rdns['q'])
-        if expiration:
-            logger.debug("Expiration {} {}".format(expiration, query))
-            r.expire(res, expiration)
-
-        firstseen = "s:{}:{}:{}".format(rdns['q'], rdns['v'], rdns['type'])
-        if not r.exists(firstseen):
-            r.set(firstseen, rdns['timestamp'])
-            logger.debug('redis set: {} -> {}'.format(firstseen, rdns['timestamp']))
-
-        if expiration:
-            logger.debug("Expiration {} {}".format(expiration, query))
-            r.expire(firstseen, expiration)
-
-        lastseen = "l:{}:{}:{}".format(rdns['q'], rdns['v'], rdns['type'])
-        last = r.get(lastseen)
-        if last is None or int(last) < int(rdns['timestamp']):
-            r.set(lastseen, rdns['timestamp'])
-            logger.debug('redis set: {} -> {}'.format(lastseen, rdns['timestamp']))
-        if expiration:
-            logger.debug("Expiration {} {}".format(expiration, query))
-            r.expire(query, expiration)
-
-        occ = "o:{}:{}:{}".format(rdns['q'], rdns['v'], rdns['type'])
-        r.incr(occ, amount=1)
-        if expiration:
-            logger.debug("Expiration {} {}".format(expiration, query))
-            r.expire(occ, expiration)
-
-
-
-        # TTL, Class, DNS Type distribution stats
-        if 'ttl' in rdns:
-            r.hincrby('dist:ttl', rdns['ttl'], amount=1)
-        if 'class' in rdns:
-            r.hincrby('dist:class', rdns['class'], amount=1)
-        if 'type' in rdns:
-            r.hincrby('dist:type', rdns['type'], amount=1)
-        if stats:
-            r.incrby('stats:processed', amount=1)
-    if not r:
-        logger.info('empty passive dns record')
+        shards = [[] for _ in worker_queues]
+        for line in lines:
+            shards[shard(line, len(worker_queues))].append(line)
+        for i, shard_lines in enumerate(shards):
+            if not shard_lines:
+                continue
+            # a full queue must not block the shutdown
+            while True:
+                try:
+                    worker_queues[i].put(shard_lines, timeout=1)
+                    break
+                except queue.Full:
+                    if stop.is_set():
+                        logger.warning('Worker {} queue full on shutdown, {} lines dropped'.format(i, len(shard_lines)))
+                        break
+
+
+def run_worker(worker_queue=None, processed=None, port=None):
+    # shutdown is coordinated by the supervisor, which sends None once
+    # the readers are stopped, also when the signal is sent to the whole
+    # process group (systemd, kill -- -pgid)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, reload_exclusion)
+    metrics.start_server(port)
+    supervisor = os.getppid()
+
+    def pop():
+        try:
+            return worker_queue.get(timeout=1)
+        except queue.Empty:
+            # no None will come if the supervisor was killed
+            return None if os.getppid() != supervisor else []
+
+    ingest(pop=pop, processed=processed)
+
+
+stop = threading.Event()
+
+
+def shutdown(signum, frame):
+    logger.info('Shutting down (signal {})'.format(signum))
+    stop.set()
+
+
+def reload_exclusion(signum, frame):
+    try:
+        rules = exclusion.reload()
+    except OSError as e:
+        logger.error('Reload of the exclusion rules failed: {}'.format(e))
+        return
+    logger.info('Reloaded {} exclusion rules, hits so far: {}'.format(rules, dict(exclusion.hits.most_common())))
+
+
+def forward_reload(signum, frame):
+    # the rules are used by the workers
+    for worker in worker_processes:
+        os.kill(worker.pid, signal.SIGHUP)
+
+
+signal.signal(signal.SIGINT, shutdown)
+signal.signal(signal.SIGTERM, shutdown)
+signal.signal(signal.SIGHUP, reload_exclusion)
+
+if workers <= 1 and len(myqueues) == 1:
+    d4queue = D4Queue(r_d4, myqueues[0], min_batch=queue_min_batch, max_batch=queue_max_batch)
+    metrics.QUEUE_DEPTH.labels(myqueues[0]).set_function(lambda: d4queue.depth)
+    metrics.start_server(metrics_port)
+
+    def pop():
+        if stop.is_set():
+            return None
+        return d4queue.pop()
+
+    ingest(pop=pop)
+    sys.exit(0)
+
+workers = max(workers, 1)
+logger.info('Starting {} ingestion workers'.format(workers))
+mp = multiprocessing.get_context('fork')
+worker_queues = [mp.Queue(maxsize=64) for _ in range(workers)]
+worker_processed = [mp.Value('Q', 0) for _ in range(workers)]
+worker_processes = [
+    mp.Process(
+        target=run_worker,
+        name='pdns-worker-{}'.format(i),
+        # the supervisor serves the metrics on metrics-port, each worker on the next ports
+        kwargs={'worker_queue': worker_queues[i], 'processed': worker_processed[i], 'port': metrics_port + 1 + i if metrics_port else 0},
+    )
+    for i in range(workers)
+]
+for worker in worker_processes:
+    worker.start()
+signal.signal(signal.SIGHUP, forward_reload)
+
+d4queues = {myqueue: D4Queue(r_d4, myqueue, min_batch=queue_min_batch, max_batch=queue_max_batch) for myqueue in myqueues}
+readers = [
+    threading.Thread(
+        target=read_queue,
+        name=myqueue,
+        kwargs={'d4queue': d4queue, 'worker_queues': worker_queues, 'stop': stop},
+    )
+    for myqueue, d4queue in d4queues.items()
+]
+for myqueue, d4queue in d4queues.items():
+    metrics.QUEUE_DEPTH.labels(myqueue).set_function(lambda d4queue=d4queue: d4queue.depth)
+metrics.register_counter(
+    'pdns_worker_records_total', 'Records written by each worker', 'worker', lambda: {i: v.value for i, v in enumerate(worker_processed)}
+)
+metrics.register_gauge(
+    'pdns_worker_queue_depth', 'Batches waiting for each worker', 'worker', lambda: {i: q.qsize() for i, q in enumerate(worker_queues)}
+)
+metrics.start_server(metrics_port)
+for reader in readers:
+    reader.start()
+
+last_processed = [0] * workers
+last_time = time.time()
+failed = False
+while not stop.wait(1):
+    # the shard of a dead worker is no longer written, the ingestor stops
+    # and exits with an error to be restarted by its supervisor
+    dead = [i for i, worker in enumerate(worker_processes) if not worker.is_alive()]
+    if dead:
+        for i in dead:
+            logger.error('Worker {} died (exit code {}), shutting down'.format(i, worker_processes[i].exitcode))
+        failed = True
+        stop.set()
+        break
+    now = time.time()
+    if now - last_time < stats_interval:
         continue
+    for i in range(workers):
+        processed = worker_processed[i].value
+        logger.info('Worker {}: {} records processed ({:.1f} records/s)'.format(i, processed, (processed - last_processed[i]) / (now - last_time)))
+        last_processed[i] = processed
+    last_time = now
+
+for reader in readers:
+    reader.join()
+for worker, worker_queue in zip(worker_processes, worker_queues):
+    if worker.is_alive():
+        worker_queue.put(None)
+    else:
+        # nothing reads the queue anymore, its buffer would block the exit
+        worker_queue.cancel_join_thread()
+for worker in worker_processes:
+    worker.join()
+for i in range(workers):
+    logger.info('Worker {}: {} records processed'.format(i, worker_processed[i].value))
+if failed:
+    sys.exit(1)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+# pdns-migrate-storage migrates the first-seen, last-seen and count of
+# the Passive DNS records from the keys layout (s:/l:/o: keys) to the
+# compact hash layout (m:<rrname>:<type> hashes).
+#
+# This software is part of the D4 project.
+#
+# The software is released under the GNU Affero General Public version 3.
+#
+# Copyright (c) Computer Incident Response Center Luxembourg (CIRCL)
+
+
+import redis
+import configparser
+import logging
+import argparse
+import time
+import os
+
+from lib.storage import Storage, retention_bucket
+
+parser = argparse.ArgumentParser(description='Migrate the Passive DNS records from the keys layout to the hash layout')
+parser.add_argument('--batch', dest='batch', type=int, default=1000, help='Number of records migrated per pipeline')
+parser.add_argument(
+    '--keep', dest='keep', action='store_true', help='Keep the s:/l:/o: keys, the records already in the hashes are then skipped'
+)
+args = parser.parse_args()
+
+config = configparser.RawConfigParser()
+config.read('../etc/analyzer.conf')
+
+logger = logging.getLogger('pdns migration')
+ch = logging.StreamHandler()
+logger.setLevel(logging.INFO)
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+if config.get('storage', 'layout', fallback='keys') != 'hash':
+    logger.warning('The storage layout in analyzer.conf is not hash, ingestors will keep on using the keys layout')
+
+analyzer_redis_host = os.getenv('D4_ANALYZER_REDIS_HOST', '127.0.0.1')
+analyzer_redis_port = int(os.getenv('D4_ANALYZER_REDIS_PORT', 6400))
+analyzer_redis_db = int(os.getenv('D4_ANALYZER_REDIS_DB', 0))
+
+r = redis.Redis(host=analyzer_redis_host, port=analyzer_redis_port, db=analyzer_redis_db)
+store = Storage(r, layout='hash', bucket=retention_bucket(config))
+
+
+def parse_key(key=None):
+    # s:<rrname>:<rdata>:<type>, the rdata can contain colons (IPv6)
+    _, rest = key.split(':', 1)
+    rrname, rest = rest.split(':', 1)
+    rdata, rtype = rest.rsplit(':', 1)
+    return rrname, rdata, rtype
+
+
+def migrate(keys=None):
+    tuples = [parse_key(key.decode('utf-8')) for key in keys]
+    pipe = r.pipeline(transaction=False)
+    for rrname, rdata, rtype in tuples:
+        pipe.mget(f's:{rrname}:{rdata}:{rtype}', f'l:{rrname}:{rdata}:{rtype}', f'o:{rrname}:{rdata}:{rtype}')
+        pipe.ttl(f's:{rrname}:{rdata}:{rtype}')
+        pipe.hexists(f'm:{rrname}:{rtype}', rdata)
+    results = pipe.execute()
+
+    # the migration can be run again: the keys are deleted in the same
+    # transaction as the upserts, or the records already migrated are
+    # skipped when they are kept
+    pipe = r.pipeline(transaction=True)
+    migrated = 0
+    for i, (rrname, rdata, rtype) in enumerate(tuples):
+        (firstseen, lastseen, count), ttl, exists = results[i * 3 : i * 3 + 3]
+        if firstseen is None or (args.keep and exists):
+            continue
+        store.upsert(
+            rrname,
+            rdata,
+            rtype,
+            first=firstseen,
+            last=lastseen if lastseen is not None else firstseen,
+            count=int(count) if count is not None else 0,
+            expiration=ttl if ttl > 0 and not store.bucket else None,
+            pipe=pipe,
+        )
+        if not args.keep:
+            pipe.delete(f's:{rrname}:{rdata}:{rtype}', f'l:{rrname}:{rdata}:{rtype}', f'o:{rrname}:{rdata}:{rtype}')
+        migrated += 1
+    pipe.execute()
+    return migrated
+
+
+start = time.time()
+migrated = 0
+keys = []
+for key in r.scan_iter(match='s:*', count=args.batch):
+    keys.append(key)
+    if len(keys) >= args.batch:
+        migrated += migrate(keys)
+        keys = []
+        logger.info('{} records migrated ({:.0f} records/s)'.format(migrated, migrated / (time.time() - start)))
+if keys:
+    migrated += migrate(keys)
+logger.info('Migration done, {} records migrated in {:.0f}s'.format(migrated, time.time() - start))
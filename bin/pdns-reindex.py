@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+#
+# pdns-reindex builds the secondary indexes enabled in the [index] section
+# of analyzer.conf for the records stored before they were enabled. The
+# ingestors and importers keep them up to date afterwards.
+#
+# This software is part of the D4 project.
+#
+# The software is released under the GNU Affero General Public version 3.
+#
+# Copyright (c) Computer Incident Response Center Luxembourg (CIRCL)
+
+
+import redis
+import configparser
+import logging
+import argparse
+import time
+import os
+
+from lib.storage import NAMES_INDEX, Storage, enabled_indexes, ignored_indexes_warning, ip_index, reverse_name
+
+parser = argparse.ArgumentParser(description='Build the secondary indexes of the existing Passive DNS records')
+parser.add_argument('--batch', dest='batch', type=int, default=1000, help='Number of keys indexed per pipeline')
+args = parser.parse_args()
+
+config = configparser.RawConfigParser()
+config.read('../etc/analyzer.conf')
+
+logger = logging.getLogger('pdns reindex')
+ch = logging.StreamHandler()
+logger.setLevel(logging.INFO)
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+indexes = enabled_indexes(config)
+if ignored_indexes_warning(config):
+    logger.warning(ignored_indexes_warning(config))
+elif not indexes:
+    logger.warning('No index enabled in the [index] section of analyzer.conf')
+
+analyzer_redis_host = os.getenv('D4_ANALYZER_REDIS_HOST', '127.0.0.1')
+analyzer_redis_port = int(os.getenv('D4_ANALYZER_REDIS_PORT', 6400))
+analyzer_redis_db = int(os.getenv('D4_ANALYZER_REDIS_DB', 0))
+
+r = redis.Redis(host=analyzer_redis_host, port=analyzer_redis_port, db=analyzer_redis_db)
+store = Storage(r, layout=config.get('storage', 'layout', fallback='keys'))
+
+# the score of a member only moves forward, a record seen by an ingestor
+# during the reindex keeps its newer last-seen (ZADD GT needs Redis 6.2)
+ZADD_MAX_LUA = """
+local score = tonumber(redis.call('ZSCORE', KEYS[1], ARGV[1]))
+if score == nil or score < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+end
+return 1
+"""
+zadd_max = r.register_script(ZADD_MAX_LUA)
+
+
+def index_names(keys=None):
+    # r:<rrname>:<type>
+    pipe = r.pipeline(transaction=False)
+    names = {reverse_name(key.decode('utf-8')[2:].rsplit(':', 1)[0]) for key in keys}
+    pipe.zadd(NAMES_INDEX, dict.fromkeys(names, 0))
+    pipe.execute()
+    return len(keys)
+
+
+def index_ips(keys=None):
+    # v:<rdata>:<type>
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        rdata, rtype = key.decode('utf-8')[2:].rsplit(':', 1)
+        entry = ip_index(rdata, rtype)
+        if entry is not None:
+            pipe.zadd(entry[0], {entry[1]: entry[2]})
+    pipe.execute()
+    return len(keys)
+
+
+def index_time(keys=None):
+    # r:<rrname>:<type>, the last-seen of each record is read from the store
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.smembers(key)
+    tuples = []
+    for key, members in zip(keys, pipe.execute()):
+        rrname, rtype = key.decode('utf-8')[2:].rsplit(':', 1)
+        tuples.extend((rrname, rdata.decode('utf-8'), rtype) for rdata in members)
+    if not tuples:
+        return len(keys)
+    store.read(pipe, tuples)
+    for (rrname, rdata, rtype), seen in zip(tuples, store.decode(pipe.execute())):
+        if seen is None or seen[1] is None:
+            continue
+        zadd_max(keys=[f'tr:{rrname}:{rtype}'], args=[rdata, seen[1]], client=pipe)
+        zadd_max(keys=[f'tv:{rdata}:{rtype}'], args=[rrname, seen[1]], client=pipe)
+    pipe.execute()
+    return len(keys)
+
+
+def index_types(keys=None):
+    # r:<rrname>:<type> and v:<rdata>:<type>, into rt:<rrname> and vt:<rdata>
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        prefix, _, rest = key.decode('utf-8').partition(':')
+        value, rtype = rest.rsplit(':', 1)
+        if rtype.isdigit():
+            pipe.setbit(f'{prefix}t:{value}', int(rtype), 1)
+    pipe.execute()
+    return len(keys)
+
+
+def reindex(match=None, index=None):
+    start = time.time()
+    indexed = 0
+    keys = []
+    for key in r.scan_iter(match=match, count=args.batch):
+        keys.append(key)
+        if len(keys) >= args.batch:
+            indexed += index(keys)
+            keys = []
+            logger.info('{} keys indexed ({:.0f} keys/s)'.format(indexed, indexed / (time.time() - start)))
+    if keys:
+        indexed += index(keys)
+    return indexed
+
+
+if 'names' in indexes:
+    logger.info('Names index done, {} keys indexed'.format(reindex('r:*', index_names)))
+if 'ips' in indexes:
+    indexed = reindex('v:*:1', index_ips) + reindex('v:*:28', index_ips)
+    logger.info('IP index done, {} keys indexed'.format(indexed))
+if 'time' in indexes:
+    logger.info('Time index done, {} keys indexed'.format(reindex('r:*', index_time)))
+if 'types' in indexes:
+    indexed = reindex('r:*', index_types) + reindex('v:*', index_types)
+    logger.info('Types index done, {} keys indexed'.format(indexed))
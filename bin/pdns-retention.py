@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+#
+# pdns-retention removes the Passive DNS records not seen for longer than
+# the retention horizon of their type, using the last-seen buckets of the
+# retention index ([retention] mode = index in analyzer.conf).
+#
+# This software is part of the D4 project.
+#
+# The software is released under the GNU Affero General Public version 3.
+#
+# Copyright (c) Computer Incident Response Center Luxembourg (CIRCL)
+
+
+import redis
+import configparser
+import logging
+import argparse
+import time
+import os
+import json
+
+from lib.storage import NAMES_INDEX, Storage, enabled_indexes, ignored_indexes_warning, ip_index, retention_bucket, reverse_name
+
+parser = argparse.ArgumentParser(description='Remove the Passive DNS records older than their retention horizon')
+parser.add_argument('--batch', dest='batch', type=int, default=1000, help='Number of records removed per pipeline')
+parser.add_argument('--interval', dest='interval', type=int, default=3600, help='Seconds between two compactions')
+parser.add_argument('--once', dest='once', action='store_true', help='Run a single compaction and exit')
+args = parser.parse_args()
+
+config = configparser.RawConfigParser()
+config.read('../etc/analyzer.conf')
+
+logger = logging.getLogger('pdns retention')
+ch = logging.StreamHandler()
+logger.setLevel(logging.INFO)
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+bucket = retention_bucket(config)
+if not bucket:
+    logger.warning('The retention mode in analyzer.conf is not index, the records are not indexed by last-seen')
+
+# horizon in seconds by type value, 0 keeps the records forever
+horizons = {rtype: int(horizon) for rtype, horizon in config.items('expiration')}
+default_horizon = config.getint('retention', 'default', fallback=0)
+
+analyzer_redis_host = os.getenv('D4_ANALYZER_REDIS_HOST', '127.0.0.1')
+analyzer_redis_port = int(os.getenv('D4_ANALYZER_REDIS_PORT', 6400))
+analyzer_redis_db = int(os.getenv('D4_ANALYZER_REDIS_DB', 0))
+
+r = redis.Redis(host=analyzer_redis_host, port=analyzer_redis_port, db=analyzer_redis_db)
+store = Storage(r, layout=config.get('storage', 'layout', fallback='keys'), bucket=bucket)
+indexes = enabled_indexes(config)
+if ignored_indexes_warning(config):
+    logger.warning(ignored_indexes_warning(config))
+
+with open('../etc/records-type.json') as rtypefile:
+    rtypes = [v['value'] for v in json.load(rtypefile)]
+
+# a bucket is forgotten once empty, unless a record was added meanwhile
+FORGET_LUA = """
+if redis.call('SCARD', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[2], KEYS[1])
+end
+return 1
+"""
+forget = r.register_script(FORGET_LUA)
+
+# the bit of a type is cleared once its set is gone, atomically so that a
+# record added meanwhile keeps it, and the bitmap removed once empty
+FORGET_TYPE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SETBIT', KEYS[2], ARGV[1], 0)
+    if redis.call('BITCOUNT', KEYS[2]) == 0 then
+        redis.call('DEL', KEYS[2])
+    end
+end
+return 1
+"""
+forget_type = r.register_script(FORGET_TYPE_LUA)
+
+
+def compact_bucket(key=None, cutoff=None):
+    # key is ret:<type>:<bucket>, its members <rrname>:<rdata>
+    _, rtype, _ = key.split(':')
+    removed = 0
+    members = []
+    for member in r.sscan_iter(key, count=args.batch):
+        members.append(member)
+        if len(members) >= args.batch:
+            removed += remove(key, rtype, members, cutoff)
+            members = []
+    if members:
+        removed += remove(key, rtype, members, cutoff)
+    forget(keys=[key, 'ret:buckets'])
+    return removed
+
+
+def remove(key=None, rtype=None, members=None, cutoff=None):
+    pipe = r.pipeline(transaction=False)
+    for member in members:
+        rrname, rdata = member.decode('utf-8').split(':', 1)
+        # a record seen after the cutoff is in a newer bucket and kept
+        store.delete(rrname, rdata, rtype, before=cutoff, pipe=pipe)
+    pipe.srem(key, *members)
+    results = pipe.execute()
+    removed = [member.decode('utf-8').split(':', 1) for member, deleted in zip(members, results) if deleted]
+    if 'names' in indexes:
+        forget_names({rrname for rrname, _ in removed})
+    if 'ips' in indexes:
+        forget_ips({rdata for _, rdata in removed}, rtype)
+    if 'time' in indexes:
+        forget_times(removed, rtype)
+    if 'types' in indexes and rtype.isdigit():
+        forget_types(removed, rtype)
+    return sum(results[:-1])
+
+
+def forget_names(names=None):
+    # a name is removed from the names index once it has no record left
+    names = list(names)
+    if not names:
+        return
+    pipe = r.pipeline(transaction=False)
+    for rrname in names:
+        pipe.exists(*[f'r:{rrname}:{rtype}' for rtype in rtypes])
+    gone = [reverse_name(rrname) for rrname, exists in zip(names, pipe.execute()) if not exists]
+    if gone:
+        r.zrem(NAMES_INDEX, *gone)
+
+
+def forget_ips(ips=None, rtype=None):
+    # an address is removed from the IP index once no name points to it
+    entries = [(rdata, ip_index(rdata, rtype)) for rdata in ips]
+    entries = [(rdata, entry) for rdata, entry in entries if entry is not None]
+    if not entries:
+        return
+    pipe = r.pipeline(transaction=False)
+    for rdata, _ in entries:
+        pipe.exists(f'v:{rdata}:{rtype}')
+    for (_, (key, member, _)), exists in zip(entries, pipe.execute()):
+        if not exists:
+            pipe.zrem(key, member)
+    pipe.execute()
+
+
+def forget_times(removed=None, rtype=None):
+    # the removed records are dropped from the time index
+    if not removed:
+        return
+    pipe = r.pipeline(transaction=False)
+    for rrname, rdata in removed:
+        pipe.zrem(f'tr:{rrname}:{rtype}', rdata)
+        pipe.zrem(f'tv:{rdata}:{rtype}', rrname)
+    pipe.execute()
+
+
+def forget_types(removed=None, rtype=None):
+    # the type bit of a name or rdata is cleared once it has no record left
+    if not removed:
+        return
+    pipe = r.pipeline(transaction=False)
+    for rrname in {rrname for rrname, _ in removed}:
+        forget_type(keys=[f'r:{rrname}:{rtype}', f'rt:{rrname}'], args=[rtype], client=pipe)
+    for rdata in {rdata for _, rdata in removed}:
+        forget_type(keys=[f'v:{rdata}:{rtype}', f'vt:{rdata}'], args=[rtype], client=pipe)
+    pipe.execute()
+
+
+def compact():
+    now = int(time.time())
+    removed = 0
+    buckets = 0
+    # only the buckets over before the current one can be compacted
+    for key, start in r.zrangebyscore('ret:buckets', '-inf', now - bucket, withscores=True):
+        key = key.decode('utf-8')
+        rtype = key.split(':')[1]
+        horizon = horizons.get(rtype, default_horizon)
+        # the buckets of the types kept forever stay indexed, their records
+        # are collected if a horizon is configured later
+        if not horizon or start + bucket > now - horizon:
+            continue
+        removed += compact_bucket(key, now - horizon)
+        buckets += 1
+    return buckets, removed
+
+
+while True:
+    start = time.time()
+    buckets, removed = compact()
+    logger.info('Compaction done, {} records removed from {} buckets in {:.0f}s'.format(removed, buckets, time.time() - start))
+    if args.once:
+        break
+    time.sleep(args.interval)